@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Serve with an ASGI server, e.g. uvicorn --factory 'asgi:create_asgi_app'
+from webapp.aio import create_asgi_app
@@ -0,0 +1,225 @@
+""" Throughput and latency of each endpoint of the API, driven through the Flask test client and through a threaded
+HTTP server, against a seeded database with moto standing in for S3:
+
+    python -m benchmarks.endpoints --users 100 --images 1000 --requests 200 --threads 8
+    python -m benchmarks.endpoints --save-baseline
+    python -m benchmarks.endpoints --threshold 0.3 --only "GET /api/users"
+
+The results are compared with the stored baseline, the exit status is 1 when a throughput is lower, or a latency
+percentile higher, than the baseline by more than the threshold. Baselines depend on the machine, record one with
+--save-baseline before comparing changes.
+"""
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from .harness import BASE_URL, access_token, serve, measure, summarize
+from .upload_concurrency import unique_image
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+PASSWORD = "benchmark"
+METRICS = ("throughput", "p50", "p95", "p99")
+
+Dataset = namedtuple("Dataset", ["token", "user_ids", "usernames", "images"])
+
+
+def seed(app, users, images):
+    """ Users sharing one precomputed password hash, and images spread over them sharing one stored content """
+    from webapp.api.model import User, Image
+    from webapp.dataset import generate
+    from webapp.modules import db
+
+    token = access_token(app)
+    with app.app_context():
+        prefix = generate(users, images, 0, password=PASSWORD, populate=True)
+        rows = db.session.query(User.id, User.username).filter(User.username.like(prefix + "-%")).all()
+        image_rows = db.session.query(Image.user_id, Image.id).filter(Image.user_id.in_([row.id for row in rows]))
+        return Dataset(token, [row.id for row in rows], [row.username for row in rows],
+                       [(row.user_id, row.id) for row in image_rows])
+
+
+def scenarios(dataset):
+    """ Request of each endpoint, as a function of the request number returning the method, path, headers, form
+    fields and files """
+    bearer = {"Authorization": "Bearer " + dataset.token}
+    basic = {"Authorization": "Basic " + base64.b64encode(b"documentation:secret").decode()}
+
+    def pick(items, number):
+        return items[number % len(items)]
+
+    def image(number, suffix=""):
+        return "/api/user/{}/image/{}{}".format(*pick(dataset.images, number), suffix)
+
+    return [
+        ("GET /api/users", lambda n: ("GET", "/api/users", bearer, {}, {})),
+        ("GET /api/user/<id>", lambda n: ("GET", "/api/user/{}".format(pick(dataset.user_ids, n)), bearer, {}, {})),
+        ("GET /api/user/<id>/image/<id>", lambda n: ("GET", image(n), bearer, {}, {})),
+        ("GET /api/user/<id>/image/<id>/raw", lambda n: ("GET", image(n, "/raw"), bearer, {}, {})),
+        ("POST /api/upload", lambda n: ("POST", "/api/upload", bearer, {"title": "benchmark"},
+                                        {"image": (unique_image(), "image.gif")})),
+        ("POST /api/login", lambda n: ("POST", "/api/login", {},
+                                       {"username": pick(dataset.usernames, n), "password": PASSWORD}, {})),
+        ("POST /auth/token", lambda n: ("POST", "/auth/token", basic,
+                                        {"username": pick(dataset.usernames, n), "password": PASSWORD,
+                                         "grant_type": "password", "scope": "read"}, {})),
+    ]
+
+
+def client_driver(app):
+    """ Send requests through a Flask test client of each thread, returns the status code """
+    local = threading.local()
+
+    def send(method, path, headers, fields, files):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        data = {**fields, **{name: (io.BytesIO(content), filename) for name, (content, filename) in files.items()}}
+        return local.client.open(path, method=method, headers=headers, data=data or None, base_url=BASE_URL).status_code
+    return send
+
+
+def http_driver(url):
+    """ Send requests over HTTP, one connection each as the development server closes them """
+    host, port = urlsplit(url).hostname, urlsplit(url).port
+
+    def send(method, path, headers, fields, files):
+        body = None
+        if files:
+            boundary, body = encode_multipart({
+                **fields, **{name: FileStorage(io.BytesIO(content), filename)
+                             for name, (content, filename) in files.items()}
+            })
+            headers = {**headers, "Content-Type": "multipart/form-data; boundary=" + boundary}
+        elif fields:
+            body = urlencode(fields).encode()
+            headers = {**headers, "Content-Type": "application/x-www-form-urlencoded"}
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+    return send
+
+
+def run(send, selected, requests, threads):
+    """ Results of each scenario, after a request warming up the caches """
+    results = dict()
+    for name, make in selected:
+        def checked(number):
+            status = send(*make(number))
+            if status >= 400:
+                raise RuntimeError("{} answered {}".format(name, status))
+
+        checked(0)
+        results[name] = summarize(*measure(checked, requests, threads))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Regressions of the results against the baseline, by more than the threshold """
+    regressions = []
+    for driver, measured in results.items():
+        for name, summary in measured.items():
+            reference = baseline.get(driver, {}).get(name)
+            if reference is None:
+                continue
+            if summary["throughput"] < reference["throughput"] * (1 - threshold):
+                regressions.append("{} {}: {:.1f} requests/s, baseline {:.1f}".format(
+                    driver, name, summary["throughput"], reference["throughput"]))
+            for metric in METRICS[1:]:
+                if summary[metric] > reference[metric] * (1 + threshold):
+                    regressions.append("{} {}: {} {:.2f} ms, baseline {:.2f}".format(
+                        driver, name, metric, summary[metric], reference[metric]))
+    return regressions
+
+
+def report(results):
+    print("{:8} {:36} {:>10} {:>10} {:>10} {:>10}".format("driver", "endpoint", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for driver, measured in results.items():
+        for name, summary in measured.items():
+            print("{:8} {:36} {:10.1f} {:10.2f} {:10.2f} {:10.2f}".format(
+                driver, name, *(summary[metric] for metric in METRICS)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="Users seeded")
+    parser.add_argument("--images", type=int, default=1000, help="Images seeded, spread over the users")
+    parser.add_argument("--requests", type=int, default=200, help="Requests measured for each endpoint")
+    parser.add_argument("--threads", type=int, default=8, help="Threads sending the requests")
+    parser.add_argument("--drivers", nargs="+", choices=["client", "http"], default=["client", "http"])
+    parser.add_argument("--only", help="Measure the endpoints whose name contains this text")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.3, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    # The database is chosen when webapp is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    os.environ.setdefault("AUTHLIB_INSECURE_TRANSPORT", "1")
+    import boto3
+    from moto import mock_s3
+    from webapp import create_app, bootstrap
+    from webapp.modules import config
+
+    mock = mock_s3()
+    mock.start()
+    boto3.resource("s3").create_bucket(Bucket=config["bucket_name"])
+    app = create_app()
+    with app.app_context():
+        bootstrap()
+    dataset = seed(app, args.users, args.images)
+    selected = [(name, make) for name, make in scenarios(dataset) if not args.only or args.only in name]
+
+    results = dict()
+    try:
+        if "client" in args.drivers:
+            results["client"] = run(client_driver(app), selected, args.requests, args.threads)
+        if "http" in args.drivers:
+            server, url = serve(app)
+            try:
+                results["http"] = run(http_driver(url), selected, args.requests, args.threads)
+            finally:
+                server.shutdown()
+    finally:
+        mock.stop()
+    report(results)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    if args.save_baseline:
+        # The endpoints that weren't measured keep their baseline
+        for driver, measured in results.items():
+            baseline.setdefault(driver, dict()).update(measured)
+        with open(args.baseline, "w") as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+        print("Saved the baseline to {}".format(args.baseline))
+        return
+    if not baseline:
+        print("No baseline at {}, record one with --save-baseline".format(args.baseline))
+        return
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
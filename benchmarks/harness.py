@@ -0,0 +1,155 @@
+import base64
+import logging
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from werkzeug.serving import make_server
+
+BASE_URL = "http://127.0.0.1"
+
+
+class StandInS3(ThreadingHTTPServer):
+    """ Local server playing S3 for the object requests of the app, each answered after the given latency """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), S3Handler)
+        self.latency = latency
+        self.objects = dict()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _object(self):
+        return unquote(urlsplit(self.path).path).lstrip("/").partition("/")[2]
+
+    def _reply(self, status, body=b"", content_type=None):
+        with self.server._lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.objects[self._object()] = (body, self.headers.get("Content-Type", "binary/octet-stream"))
+        self._reply(200)
+
+    def do_GET(self):
+        if self._object() not in self.server.objects:
+            return self._reply(404, b"<Error><Code>NoSuchKey</Code></Error>", "application/xml")
+        body, content_type = self.server.objects[self._object()]
+        self._reply(200, body, content_type)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_DELETE(self):
+        self.server.objects.pop(self._object(), None)
+        self._reply(204)
+
+
+async def asgi_request(app, method, path, headers=None, body=b"", query=b""):
+    """ Call the ASGI app in process, returns the status, headers and body of the response """
+    headers = {"Host": "127.0.0.1", **(headers or {})}
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+        "root_path": "", "query_string": query, "server": ("127.0.0.1", 80), "client": ("127.0.0.1", 0),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {"body": b""}
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode("latin-1"): value.decode("latin-1")
+                                   for name, value in message["headers"]}
+        else:
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+def access_token(app, scope="read write"):
+    """ Register a user and get a token for it through the documentation client """
+    client = app.test_client()
+    credentials = {"username": uuid.uuid4().hex, "password": "benchmark"}
+    client.post("/api/register", data=credentials, base_url=BASE_URL)
+    response = client.post("/auth/token", data={**credentials, "grant_type": "password", "scope": scope},
+                           headers={"Authorization": "Basic " + base64.b64encode(b"documentation:secret").decode()},
+                           base_url=BASE_URL)
+    return response.get_json()["access_token"]
+
+
+def serve(app):
+    """ Serve the WSGI app from a threaded server on a free local port, returns the server and its URL """
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "{}:{}".format(BASE_URL, server.server_port)
+
+
+def measure(send, count, threads):
+    """ Call send with the numbers of count requests from the threads, returns the latency of each request in
+    seconds and the elapsed time """
+    latencies = [0.0] * count
+
+    def timed(number):
+        start = time.perf_counter()
+        send(number)
+        latencies[number] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(timed, range(count)))
+    return latencies, time.perf_counter() - start
+
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of the sorted values """
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """ Throughput in requests per second and latency percentiles in milliseconds """
+    ordered = sorted(latencies)
+    return {
+        "throughput": len(ordered) / elapsed,
+        "p50": percentile(ordered, 0.50) * 1000,
+        "p95": percentile(ordered, 0.95) * 1000,
+        "p99": percentile(ordered, 0.99) * 1000,
+    }
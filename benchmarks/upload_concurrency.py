@@ -0,0 +1,98 @@
+""" Concurrent-upload throughput of the sync Flask path against the asyncio entry point, with a local server
+playing S3 at the given latency:
+
+    python -m benchmarks.upload_concurrency --uploads 200 --threads 8 --concurrency 64 --latency-ms 50
+"""
+import argparse
+import asyncio
+import io
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from .harness import BASE_URL, StandInS3, asgi_request, access_token
+
+IMAGE_FILE = b'GIF89a\x01\x00\x01\x00\x00\xff\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x00;'
+
+
+def unique_image():
+    """ Identical uploads are deduplicated, each upload has its own content to measure the writes """
+    from PIL import Image as Picture
+    content = io.BytesIO()
+    Picture.new("P", (1, 1)).save(content, "GIF", comment=uuid.uuid4().hex)
+    return content.getvalue()
+
+
+def run_sync(app, headers, uploads, threads):
+    def upload(_):
+        response = app.test_client().post("/api/upload", headers=headers, base_url=BASE_URL,
+                                          data={"image": (io.BytesIO(unique_image()), "image.gif"), "title": "sync"})
+        assert response.status_code == 200, response.get_data()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(upload, range(uploads)))
+    return uploads / (time.perf_counter() - start)
+
+
+async def run_async(asgi_app, headers, uploads, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def upload():
+        boundary, body = encode_multipart({
+            "image": FileStorage(io.BytesIO(unique_image()), "image.gif", content_type="image/gif"),
+            "title": "async"
+        })
+        upload_headers = {**headers, "Content-Type": "multipart/form-data; boundary=" + boundary}
+        async with slots:
+            status, _, data = await asgi_request(asgi_app, "POST", "/api/upload", upload_headers, body)
+            assert status == 200, data
+
+    start = time.perf_counter()
+    await asyncio.gather(*(upload() for _ in range(uploads)))
+    elapsed = time.perf_counter() - start
+    await asgi_app.s3.close()
+    return uploads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8, help="Threads serving the sync path")
+    parser.add_argument("--concurrency", type=int, default=64, help="Uploads in flight on the async path")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of each S3 request")
+    args = parser.parse_args()
+
+    # The database is chosen when webapp is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    os.environ.setdefault("AUTHLIB_INSECURE_TRANSPORT", "1")
+    from webapp import create_app, bootstrap
+    from webapp.aio import AsyncApi
+    from webapp.modules import config
+    from webapp.s3 import s3_client
+
+    server = StandInS3(args.latency_ms / 1000).start()
+    config["s3_endpoint_url"] = server.url
+    s3_client.reset()
+    app = create_app()
+    with app.app_context():
+        bootstrap()
+    headers = {"Authorization": "Bearer " + access_token(app)}
+    try:
+        sync = run_sync(app, headers, args.uploads, args.threads)
+        print("sync  ({} threads):     {:8.1f} uploads/s".format(args.threads, sync))
+        asynchronous = asyncio.run(run_async(AsyncApi(app), headers, args.uploads, args.concurrency))
+        print("async ({} in flight):   {:8.1f} uploads/s".format(args.concurrency, asynchronous))
+        print("speedup:              {:8.1f}x".format(asynchronous / sync))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
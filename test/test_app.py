@@ -1,20 +1,62 @@
 import io
+import json
 import os
+import signal
+import subprocess
+import sys
+import asyncio
+import threading
+import time
 
 import boto3
 import pytest
 import uuid
 import base64
+import hashlib
 
+from benchmarks.endpoints import Dataset, scenarios, client_driver, run, compare
+from benchmarks.harness import StandInS3, asgi_request, summarize
+from botocore.credentials import Credentials
+from botocore.retries.standard import ExponentialBackoff
 from botocore.stub import Stubber
 from moto import mock_s3
-from webapp import create_app
-from webapp.modules import client_s3, config
+from webapp import create_app, bootstrap
+from webapp.auth.model import OAuth2Client, OAuth2Token, OAuth2AuthorizationCode
+from webapp.auth.oauth2 import (authorization, require_oauth, token_cache, SignedBearerToken,
+                                SignedBearerTokenValidator, SignedToken, forget_token)
+from webapp.auth.sweeper import sweep_expired, Sweeper
+from passlib.hash import pbkdf2_sha256
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from sqlalchemy import create_engine, inspect
+from webapp.api.model import User, Image, Blob, PENDING
+from webapp.hashing import hasher
+from webapp.migrations import migrate, MIGRATIONS
+from webapp.modules import config, db, schemas
+from webapp.s3 import S3ClientFactory, s3_client
+from webapp.spool import Spooler, spooler, claim
+from webapp.aio import AsyncApi, AsyncS3Client, S3Error
+from webapp.aio.app import read_body
+from webapp.cache import ResponseCache, FileSystemCache, BlobCache, Denylist
+from webapp.dataset import generate
+from webapp.derivatives import derivatives
+from webapp.storage import storage, expire_pending_uploads, LocalStorage, StorageError, store_content
+from webapp.util import response_cache, image_cache, HashingRequest, encode_cursor
 
 BUCKET = config["bucket_name"]
 
+# Startup budget of a worker, see "Startup time" in the README
+IMPORT_BUDGET_MS = 1000
+LAZY_MODULES = ("boto3", "magic", "authlib.jose", "PIL")
+
 IMAGE_FILE = b'GIF89a\x01\x00\x01\x00\x00\xff\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x00;'
 
+
+def unique_image():
+    """ An image whose content no other upload shares, so that it is stored and deleted on its own """
+    return IMAGE_FILE + uuid.uuid4().bytes
+
+
 TEST_USER_CREDENTIALS = {
     "username": uuid.uuid4().hex,  # Prevent conflicts with existing users
     "password": "testpw"
@@ -69,6 +111,8 @@ def client(moto_boto):
     testing_client = app.test_client()
     ctx = app.app_context()
     ctx.push()
+    db.drop_all()
+    bootstrap()
     yield testing_client
     ctx.pop()
     
@@ -186,6 +230,51 @@ def test_list_users_success(client):
     assert response.status_code == 200
 
 
+def test_list_users_paginated(client):
+    response = client.get(
+        "api/users",
+        query_string={"limit": 1},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json["users"]] == [1]
+    assert "prev" not in response.json["_links"]
+
+    # Follow the next link
+    response = client.get(
+        "api" + response.json["_links"]["next"]["href"],
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json["users"]] == [2]
+
+    # Go back with the prev link
+    response = client.get(
+        "api" + response.json["_links"]["prev"]["href"],
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json["users"]] == [1]
+    assert "prev" not in response.json["_links"]
+
+
+def test_list_users_invalid_cursor(client):
+    response = client.get(
+        "api/users",
+        query_string={"after": "not-a-cursor"},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 400
+    for limit in (0, -1):
+        response = client.get("api/users", query_string={"limit": limit},
+                              headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+        assert response.status_code == 400
+
+
 @pytest.mark.actions
 def test_upload_image_success(client):
     # Upload image
@@ -327,3 +416,1127 @@ def test_get_images_user_not_present(client):
 
     assert response.status_code == 404
 
+
+@pytest.mark.actions
+def test_get_images_paginated(client):
+    for title in ("first", "second"):
+        client.post(
+            "api/upload",
+            data={"title": title, "image": (io.BytesIO(IMAGE_FILE), "file.jpg")},
+            headers={"Authorization": "Bearer " + oauth_token_password},
+            follow_redirects=True
+        )
+    response = client.get(
+        "api/user/3",
+        query_string={"limit": 1},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert [image["title"] for image in response.json["images"]] == ["first"]
+
+    # Follow the next link
+    response = client.get(
+        "api" + response.json["_links"]["next"]["href"],
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert [image["title"] for image in response.json["images"]] == ["second"]
+    assert "next" not in response.json["_links"]
+
+
+def test_revoke_token_invalidates_cache(client):
+    basic = "Basic " + base64.b64encode("{client_id}:{client_secret}".format(**oauth_client).encode()).decode()
+    response = client.post(
+        "auth/token",
+        data={**TEST_TOKEN_DATA, "grant_type": "password"},
+        headers={"Authorization": basic},
+        follow_redirects=True
+    )
+    token = response.get_json()["access_token"]
+
+    # Repeated requests are validated from the cache
+    hits = token_cache.hits
+    for _ in range(2):
+        response = client.get("api/users", headers={"Authorization": "Bearer " + token}, follow_redirects=True)
+        assert response.status_code == 200
+    assert token_cache.hits == hits + 1
+
+    response = client.post(
+        "auth/revoke",
+        data={"token": token, "token_type_hint": "access_token"},
+        headers={"Authorization": basic},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    response = client.get("api/users", headers={"Authorization": "Bearer " + token}, follow_redirects=True)
+    assert response.status_code == 401
+
+
+def test_upload_image_too_large(client, monkeypatch):
+    # The declared length exceeds the limit, the body is not read, not even by the authentication
+    streams = []
+    monkeypatch.setattr(HashingRequest, "_get_file_stream", lambda *args: streams.append(args))
+    response = client.post(
+        "api/upload",
+        data={"title": "large", "image": (io.BytesIO(IMAGE_FILE + b"\x00" * 5000 * 1000), "file.gif")},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 413
+    assert streams == []
+    monkeypatch.undo()
+
+    # The request fits the form allowance but the image is over the size limit
+    response = client.post(
+        "api/upload",
+        data={"title": "large", "image": (io.BytesIO(IMAGE_FILE + b"\x00" * config["max_size_kb"] * 1000), "file.gif")},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.actions
+def test_presigned_upload_success(client):
+    response = client.post(
+        "api/upload/presigned",
+        data={"title": "direct", "content_type": "image/gif", "size": len(IMAGE_FILE)},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    upload = response.json
+    assert upload["fields"]["key"] == upload["guid"]
+
+    # The image is not visible until the upload is completed
+    response = client.get("api" + upload["_links"]["self"]["href"],
+                          headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 404
+    response = client.post("api" + upload["_links"]["complete"]["href"],
+                           headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 400
+
+    # Upload the image as the client would, straight to the bucket
+    boto3.resource("s3").Bucket(BUCKET).put_object(Body=IMAGE_FILE, Key=upload["guid"], ContentType="image/gif")
+    response = client.post("api" + upload["_links"]["complete"]["href"],
+                           headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 200
+    response = client.get("api" + upload["_links"]["self"]["href"],
+                          headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 200
+    assert response.json["title"] == "direct"
+
+
+def test_presigned_upload_expired(client):
+    response = client.post(
+        "api/upload/presigned",
+        data={"title": "never", "content_type": "image/gif", "size": len(IMAGE_FILE)},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert expire_pending_uploads() == 0
+    assert expire_pending_uploads(now=time.time() + config["presigned_expiry"] + 1) == 1
+    response = client.post("api" + response.json["_links"]["complete"]["href"],
+                           headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 404
+
+
+def test_sweeper_expires_pending_uploads(client, monkeypatch):
+    response = client.post(
+        "api/upload/presigned",
+        data={"title": "abandoned", "content_type": "image/gif", "size": len(IMAGE_FILE)},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    guid = response.json["guid"]
+    now = time.time() + config["presigned_expiry"] + 1
+    monkeypatch.setattr(time, "time", lambda: now)
+    Sweeper.sweep()
+    assert Image.query.filter_by(guid=guid).first() is None
+
+
+def test_presigned_upload_not_image(client):
+    response = client.post(
+        "api/upload/presigned",
+        data={"title": "text", "content_type": "text/plain", "size": 10},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.actions
+def test_batch_upload(client):
+    response = client.post(
+        "api/upload/batch",
+        data={
+            "title": ["album1", "album2", "notanimage"],
+            "image": [(io.BytesIO(IMAGE_FILE), "1.gif"), (io.BytesIO(IMAGE_FILE), "2.gif"),
+                      (io.BytesIO(b"abcdef"), "3.gif")]
+        },
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    results = response.json["images"]
+    assert [result["success"] for result in results] == [True, True, False]
+    for result in results[:2]:
+        response = client.get("api" + result["_links"]["self"]["href"],
+                              headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+        assert response.status_code == 200
+        assert response.json["title"] == result["title"]
+
+
+def test_batch_upload_mismatched_titles(client):
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["only"], "image": [(io.BytesIO(IMAGE_FILE), "1.gif"), (io.BytesIO(IMAGE_FILE), "2.gif")]},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.actions
+def test_bulk_delete_images(client):
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["bulk1", "bulk2"], "image": [(io.BytesIO(IMAGE_FILE), "1.gif"), (io.BytesIO(IMAGE_FILE), "2.gif")]},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    ids = [result["id"] for result in response.json["images"]]
+
+    # Delete the selected images
+    response = client.delete(
+        "api/user/3/images",
+        query_string={"id": ids},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert response.json == {"deleted": 2, "errors": []}
+    for image_id in ids:
+        response = client.get("api/user/3/image/{}".format(image_id),
+                              headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+        assert response.status_code == 404
+
+    # Delete all the remaining images of the user
+    response = client.delete(
+        "api/user/3/images",
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert response.json["deleted"] > 0
+    response = client.get("api/user/3", headers={"Authorization": "Bearer " + oauth_token_password},
+                          follow_redirects=True)
+    assert response.json["images"] == []
+    assert list(boto3.resource("s3").Bucket(BUCKET).objects.all()) == []
+
+
+def test_bulk_delete_shared_content(client, monkeypatch):
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    shared, unique = unique_image(), unique_image()
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["shared1", "unique", "shared2"],
+              "image": [(io.BytesIO(shared), "1.gif"), (io.BytesIO(unique), "2.gif"), (io.BytesIO(shared), "3.gif")]},
+        headers=headers,
+        follow_redirects=True
+    )
+    ids = [result["id"] for result in response.json["images"]]
+    digest = hashlib.sha256(shared).hexdigest()
+
+    # The errors list every image using the content that couldn't be deleted, and their references are kept
+    routes_storage = sys.modules["webapp.api.routes"].storage
+    monkeypatch.setattr(routes_storage, "delete_many", lambda keys: [
+        {"Key": key, "Code": "AccessDenied", "Message": "Access Denied"} for key in keys if key == digest])
+    response = client.delete("api/user/3/images", query_string={"id": ids}, headers=headers, follow_redirects=True)
+    assert response.json["deleted"] == 1
+    assert [sorted(error["ids"]) for error in response.json["errors"]] == [[ids[0], ids[2]]]
+    assert Blob.query.get(digest).refs == 2
+
+    monkeypatch.undo()
+    response = client.delete("api/user/3/images", query_string={"id": ids}, headers=headers, follow_redirects=True)
+    assert response.json == {"deleted": 2, "errors": []}
+    assert Image.query.filter(Image.id.in_(ids)).count() == 0
+    assert Blob.query.get(digest) is None
+
+
+def test_bulk_delete_other_user(client):
+    response = client.delete(
+        "api/user/1/images",
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 401
+
+
+@pytest.mark.actions
+def test_upload_image_write_behind(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "write_behind", True)
+    monkeypatch.setattr(spooler, "directory", str(tmp_path))
+    response = client.post(
+        "api/upload",
+        data={"title": "spooled", "image": (io.BytesIO(IMAGE_FILE), "file.gif")},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    assert response.status_code == 202
+    assert response.json["status"] == "pending"
+    spooler.join()
+
+    response = client.get("api" + response.json["_links"]["self"]["href"],
+                          headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 200
+    assert response.json["status"] == "active"
+    key = Image.query.filter_by(guid=response.json["guid"]).first().key
+    assert key == hashlib.sha256(IMAGE_FILE).hexdigest()
+    assert boto3.resource("s3").Object(BUCKET, key).get()["Body"].read() == IMAGE_FILE
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spool_survives_restart(client, tmp_path):
+    # An upload spooled by a process that stopped before storing it
+    image = Image(title="restarted", user_id=3, status=PENDING)
+    db.session.add(image)
+    db.session.commit()
+    (tmp_path / image.guid).write_bytes(IMAGE_FILE)
+
+    restarted = Spooler(str(tmp_path), workers=1, retries=1, retry_delay=0)
+    restarted.start()
+    restarted.join()
+    db.session.refresh(image)
+    assert image.status == "active"
+    assert boto3.resource("s3").Object(BUCKET, image.key).get()["Body"].read() == IMAGE_FILE
+
+
+def test_spool_after_fork(tmp_path):
+    forked = Spooler(str(tmp_path), workers=1, retries=1, retry_delay=0)
+    forked.start()
+    pid = os.fork()
+    if pid == 0:
+        # The child drains its queue with workers of its own, or is killed by the alarm
+        signal.alarm(5)
+        forked.start()
+        forked._queue.put("missing")
+        forked.join()
+        os._exit(0 if threading.active_count() > 1 else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_spool_shared_by_processes(client, tmp_path):
+    image = Image(title="claimed", user_id=3, status=PENDING)
+    db.session.add(image)
+    db.session.commit()
+    (tmp_path / image.guid).write_bytes(IMAGE_FILE)
+    (tmp_path / "abandoned.tmp").write_bytes(b"partial")
+    os.utime(str(tmp_path / "abandoned.tmp"), (time.time() - 3600,) * 2)
+    (tmp_path / "writing.tmp").write_bytes(b"partial")
+    os.utime(str(tmp_path / "writing.tmp"), (time.time() - 3600,) * 2)
+
+    # Files locked by another worker process are left to it
+    writing = claim(str(tmp_path / "writing.tmp"))
+    owner = claim(str(tmp_path / image.guid))
+    started = Spooler(str(tmp_path), workers=1, retries=1, retry_delay=0)
+    started.start()
+    started.join()
+    db.session.refresh(image)
+    assert image.status == PENDING
+    assert sorted(os.listdir(str(tmp_path))) == sorted([image.guid, "writing.tmp"])
+    assert claim(str(tmp_path / image.guid)) is None
+
+    owner.close()
+    writing.close()
+    started._queue.put(image.guid)
+    started.join()
+    db.session.refresh(image)
+    assert image.status == "active"
+    assert os.listdir(str(tmp_path)) == ["writing.tmp"]
+
+
+def test_conditional_requests(client):
+    for path in ("api/users", "api/user/3"):
+        response = client.get(path, headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        response = client.get(
+            path,
+            headers={"Authorization": "Bearer " + oauth_token_password, "If-None-Match": etag},
+            follow_redirects=True
+        )
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.data == b""
+
+
+@pytest.mark.actions
+def test_conditional_request_image(client):
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["conditional"], "image": [(io.BytesIO(IMAGE_FILE), "1.gif")]},
+        headers={"Authorization": "Bearer " + oauth_token_password},
+        follow_redirects=True
+    )
+    path = "api" + response.json["images"][0]["_links"]["self"]["href"]
+    response = client.get(path, headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+    for condition in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+        response = client.get(path, headers={"Authorization": "Bearer " + oauth_token_password, **condition},
+                              follow_redirects=True)
+        assert response.status_code == 304
+
+    # The list of images changes once the image is deleted
+    response = client.get("api/user/3", headers={"Authorization": "Bearer " + oauth_token_password},
+                          follow_redirects=True)
+    etag = response.headers["ETag"]
+    client.delete(path, headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    response = client.get("api/user/3", headers={"Authorization": "Bearer " + oauth_token_password,
+                                                 "If-None-Match": etag}, follow_redirects=True)
+    assert response.status_code == 200
+
+
+def test_response_cache(client):
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    client.get("api/users", headers=headers, follow_redirects=True)
+    hits = response_cache.hits
+    response = client.get("api/users", headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert response_cache.hits == hits + 1
+
+    # Registering a user invalidates the list of users
+    client.post("api/register", data={"username": uuid.uuid4().hex, "password": "pw"}, follow_redirects=True)
+    response = client.get("api/users", headers=headers, follow_redirects=True)
+    assert response_cache.hits == hits + 1
+    assert len(response.json["users"]) == max_id + 1
+
+    response = client.get("api/stats", headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert response.json["response_cache"]["hits"] == hits + 1
+    assert response.json["response_cache"]["memory"] > 0
+
+
+def test_file_system_cache(tmp_path):
+    # Two processes of the same host share the entries and the invalidations
+    first = ResponseCache(FileSystemCache(str(tmp_path), maxsize=10, ttl=60), lambda headers: None)
+    second = ResponseCache(FileSystemCache(str(tmp_path), maxsize=10, ttl=60), lambda headers: None)
+    first.set(first.key("users", "/users"), {"users": []}, {"ETag": "\"etag\""})
+    assert second.get(second.key("users", "/users")) == [{"users": []}, {"ETag": "\"etag\""}]
+    second.invalidate("users")
+    assert first.get(first.key("users", "/users")) is None
+
+
+def test_login_rehashes_old_password(client):
+    user = User(username=uuid.uuid4().hex, password=pbkdf2_sha256.using(rounds=1000).hash("oldpw"))
+    db.session.add(user)
+    db.session.commit()
+    response = client.post("api/login", data={"username": user.username, "password": "oldpw"}, follow_redirects=True)
+    assert response.status_code == 200
+    db.session.refresh(user)
+    assert pbkdf2_sha256.from_string(user.password).rounds == config["hash_rounds"]
+    assert user.check_password("oldpw")
+
+
+def test_password_hashing_overloaded(client):
+    # Fill every slot of the hashing queue
+    slots = 0
+    while hasher._slots.acquire(blocking=False):
+        slots += 1
+    try:
+        response = client.post("api/login", data=TEST_USER_CREDENTIALS, follow_redirects=True)
+    finally:
+        for _ in range(slots):
+            hasher._slots.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_sqlite_tuning(client):
+    with db.engine.connect() as connection:
+        assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.execute("PRAGMA foreign_keys").scalar() == 1
+        assert connection.execute("PRAGMA busy_timeout").scalar() == config["sqlite_busy_timeout_ms"]
+
+
+def query_plan(sql):
+    with db.engine.connect() as connection:
+        return " ".join(row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + sql))
+
+
+def test_query_plans_use_indexes(client):
+    plan = query_plan("SELECT id, guid, title FROM images WHERE user_id = 3 AND status = 'active' AND id > 1 "
+                      "ORDER BY id LIMIT 51")
+    assert "USING INDEX ix_images_user_id_status_id" in plan
+    assert "TEMP B-TREE" not in plan
+    plan = query_plan("SELECT id FROM images WHERE status = 'reserved' AND created_at < 0")
+    assert "ix_images_status_created_at" in plan
+    plan = query_plan("SELECT * FROM oauth2_token WHERE access_token = 'token'")
+    assert "USING INDEX" in plan
+    plan = query_plan("SELECT * FROM oauth2_token WHERE refresh_token = 'token'")
+    assert "USING INDEX" in plan
+    plan = query_plan("SELECT * FROM oauth2_code WHERE code = 'code' AND client_id = 'client'")
+    assert "USING INDEX" in plan
+
+
+def test_migrate_existing_database(tmp_path):
+    # Schema of the images and users tables before timestamps, statuses and indexes were introduced
+    engine = create_engine("sqlite:///" + str(tmp_path / "old.db"))
+    engine.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(120) NOT NULL UNIQUE, "
+                   "password VARCHAR(120) NOT NULL)")
+    engine.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, guid VARCHAR(32) NOT NULL UNIQUE, "
+                   "title VARCHAR(120) NOT NULL, user_id INTEGER NOT NULL REFERENCES users (id))")
+    engine.execute("INSERT INTO users VALUES (1, 'old', 'hash')")
+    engine.execute("INSERT INTO images VALUES (1, 'guid', 'old image', 1)")
+
+    assert migrate(engine) == [version for version, _ in MIGRATIONS]
+    assert migrate(engine) == []
+    assert engine.execute("SELECT title, status FROM images").fetchall() == [("old image", "active")]
+    assert "ix_images_user_id_status_id" in {index["name"] for index in inspect(engine).get_indexes("images")}
+    assert "oauth2_token" in inspect(engine).get_table_names()
+
+
+def test_sweep_expired_tokens(client):
+    expired_token = OAuth2Token(client_id="documentation", user_id=1, token_type="Bearer", access_token=uuid.uuid4().hex,
+                                issued_at=1000, expires_in=3600)
+    expired_code = OAuth2AuthorizationCode(code=uuid.uuid4().hex, client_id="documentation", user_id=1, auth_time=1000)
+    db.session.add_all([expired_token, expired_code])
+    db.session.commit()
+    expired_ids = (expired_token.id, expired_code.id)
+
+    removed = sweep_expired(chunk_size=1)
+    assert removed["tokens"] >= 1
+    assert removed["codes"] >= 1
+    assert OAuth2Token.query.get(expired_ids[0]) is None
+    assert OAuth2AuthorizationCode.query.get(expired_ids[1]) is None
+
+    # Active tokens are kept
+    response = client.get("api/users", headers={"Authorization": "Bearer " + oauth_token_password},
+                          follow_redirects=True)
+    assert response.status_code == 200
+    assert OAuth2Token.query.filter_by(access_token=oauth_token_password).count() == 1
+
+
+def test_signed_tokens(client):
+    generate_token = authorization.generate_token
+    validator = require_oauth._token_validators["bearer"]
+    authorization.generate_token = SignedBearerToken(generate_token, "secret")
+    require_oauth._token_validators["bearer"] = SignedBearerTokenValidator("secret")
+    basic = "Basic " + base64.b64encode("{client_id}:{client_secret}".format(**oauth_client).encode()).decode()
+    try:
+        tokens = []
+        for _ in range(2):
+            response = client.post(
+                "auth/token",
+                data={**TEST_TOKEN_DATA, "grant_type": "password"},
+                headers={"Authorization": basic},
+                follow_redirects=True
+            )
+            assert response.status_code == 200
+            tokens.append(response.get_json()["access_token"])
+            assert tokens[-1].count(".") == 2
+
+        # Validated from the signature alone
+        OAuth2Token.query.filter_by(access_token=tokens[0]).delete()
+        db.session.commit()
+        response = client.get("api/users", headers={"Authorization": "Bearer " + tokens[0]}, follow_redirects=True)
+        assert response.status_code == 200
+        response = client.get("api/users", headers={"Authorization": "Bearer " + tokens[0][:-2]},
+                              follow_redirects=True)
+        assert response.status_code == 401
+
+        # Revoked tokens are denied until they expire
+        response = client.post(
+            "auth/revoke",
+            data={"token": tokens[1], "token_type_hint": "access_token"},
+            headers={"Authorization": basic},
+            follow_redirects=True
+        )
+        assert response.status_code == 200
+        response = client.get("api/users", headers={"Authorization": "Bearer " + tokens[1]}, follow_redirects=True)
+        assert response.status_code == 401
+
+        # Tokens issued before the switch are still validated from the database
+        response = client.get("api/users", headers={"Authorization": "Bearer " + oauth_token_password},
+                              follow_redirects=True)
+        assert response.status_code == 200
+    finally:
+        authorization.generate_token = generate_token
+        require_oauth._token_validators["bearer"] = validator
+
+
+def test_denylist_keeps_every_revoked_token():
+    validator = SignedBearerTokenValidator("secret")
+    claims = {"cid": "documentation", "scope": "read", "exp": time.time() + 3600}
+    revoked = [SignedToken("header.claims.{}".format(number), claims)
+               for number in range(config["token_cache_size"] + 10)]
+    for token in revoked:
+        forget_token(token)
+    # More revocations than the token cache holds, none of them is dropped before it expires
+    assert all(validator.token_revoked(token) for token in revoked)
+
+    denylist = Denylist()
+    denylist.add("expired", 0.01)
+    denylist.add("live", 3600)
+    time.sleep(0.02)
+    denylist.add("purging", 3600)
+    assert "expired" not in denylist
+    assert ("live" in denylist, "purging" in denylist, len(denylist)) == (True, True, 2)
+
+
+def test_signed_tokens_long_client_id(client):
+    generate_token = authorization.generate_token
+    authorization.generate_token = SignedBearerToken(generate_token, "secret")
+    long_client = OAuth2Client(client_id="c" * 48, client_id_issued_at=int(time.time()), user_id=3,
+                               client_secret="secret")
+    long_client.set_client_metadata({"grant_types": ["password"], "scope": "read write",
+                                     "token_endpoint_auth_method": "client_secret_basic"})
+    db.session.add(long_client)
+    db.session.commit()
+    basic = "Basic " + base64.b64encode("{}:secret".format("c" * 48).encode()).decode()
+    try:
+        response = client.post("auth/token", data={**TEST_TOKEN_DATA, "grant_type": "password"},
+                               headers={"Authorization": basic}, follow_redirects=True)
+        assert response.status_code == 200
+        access_token = response.get_json()["access_token"]
+    finally:
+        authorization.generate_token = generate_token
+    assert 255 < len(access_token) <= OAuth2Token.__table__.c.access_token.type.length
+    assert OAuth2Token.query.filter_by(access_token=access_token).count() == 1
+
+    # The column is widened on the engines enforcing its length
+    statements = []
+
+    class Connection:
+        def __init__(self, dialect):
+            self.dialect = type("Dialect", (), {"name": dialect})
+
+        def execute(self, statement):
+            statements.append(statement)
+
+    widen = dict(MIGRATIONS)[10]
+    for dialect in ("postgresql", "mysql", "sqlite"):
+        widen(Connection(dialect))
+    assert statements == ["ALTER TABLE oauth2_token ALTER COLUMN access_token TYPE VARCHAR(768)",
+                          "ALTER TABLE oauth2_token MODIFY access_token VARCHAR(768) NOT NULL"]
+
+
+def test_bootstrap_idempotent(client):
+    users = User.query.count()
+    clients = OAuth2Client.query.count()
+    assert bootstrap() == []
+    assert User.query.count() == users
+    assert OAuth2Client.query.count() == clients
+    assert OAuth2Client.query.filter(OAuth2Client.client_id.in_(["documentation", "dummy"])).count() == 2
+
+
+def import_time_ms():
+    """ Cumulative time of `import webapp` in a fresh interpreter, as reported by -X importtime """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import sys, webapp; print(','.join(m for m in {} if m in sys.modules))".format(LAZY_MODULES)],
+        cwd=os.path.join(os.path.dirname(__file__), ".."), capture_output=True, text=True, check=True
+    )
+    line = [line for line in result.stderr.splitlines() if line.endswith("| webapp")][-1]
+    return int(line.split("|")[1]) / 1000, result.stdout.strip()
+
+
+def test_import_time_budget():
+    timings = [import_time_ms() for _ in range(3)]
+    assert all(loaded == "" for _, loaded in timings)
+    assert min(elapsed for elapsed, _ in timings) < IMPORT_BUDGET_MS
+
+
+def test_s3_client_factory(client):
+    factory = S3ClientFactory({**config, "s3_max_pool_connections": 7, "s3_retry_mode": "adaptive"})
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(factory())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(c) for c in clients}) == 1
+    assert clients[0].meta.config.max_pool_connections == 7
+    assert clients[0].meta.config.retries["mode"] == "adaptive"
+
+    # A forked worker builds its own client
+    factory.reset()
+    assert factory() is not clients[0]
+    assert s3_client().head_bucket(Bucket=BUCKET)["ResponseMetadata"]["HTTPStatusCode"] == 200
+
+
+def test_asgi_upload_read_delete(client):
+    server = StandInS3().start()
+    s3 = AsyncS3Client(Credentials("testing", "testing"), server.url, "us-east-1", BUCKET, 4)
+    asgi_app = AsyncApi(client.application, s3)
+    authorization = {"Authorization": "Bearer " + oauth_token_password}
+    content = unique_image()
+    key = hashlib.sha256(content).hexdigest()
+    boundary, body = encode_multipart({
+        "image": FileStorage(io.BytesIO(content), "image.gif", content_type="image/gif"),
+        "title": "async"
+    })
+    upload_headers = {**authorization, "Content-Type": "multipart/form-data; boundary=" + boundary}
+
+    async def scenario():
+        status, _, _ = await asgi_request(asgi_app, "POST", "/api/upload", upload_headers, body)
+        assert status == 200
+        status, _, _ = await asgi_request(asgi_app, "POST", "/api/upload", {}, body)
+        assert status == 401
+        # Served by the Flask app
+        status, _, user = await asgi_request(asgi_app, "GET", "/api/user/{}".format(max_id), authorization,
+                                             query=b"limit=200")
+        assert status == 200
+        image = [image for image in json.loads(user)["images"] if image["title"] == "async"][0]
+        assert key in server.objects
+        status, _, _ = await asgi_request(asgi_app, "GET", "/api" + image["_links"]["self"]["href"], authorization)
+        assert status == 200
+        status, _, _ = await asgi_request(asgi_app, "DELETE", "/api" + image["_links"]["self"]["href"],
+                                          authorization)
+        assert status == 200
+        assert key not in server.objects
+        status, _, _ = await asgi_request(asgi_app, "DELETE", "/api" + image["_links"]["self"]["href"],
+                                          authorization)
+        assert status == 404
+        await s3.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.stop()
+
+
+def test_asgi_delete_failure_keeps_image(client):
+    server = StandInS3().start()
+    s3 = AsyncS3Client(Credentials("testing", "testing"), server.url, "us-east-1", BUCKET, 4)
+    asgi_app = AsyncApi(client.application, s3)
+    authorization = {"Authorization": "Bearer " + oauth_token_password}
+    content = unique_image()
+    key = hashlib.sha256(content).hexdigest()
+    boundary, body = encode_multipart({"image": FileStorage(io.BytesIO(content), "image.gif"), "title": "kept"})
+    upload_headers = {**authorization, "Content-Type": "multipart/form-data; boundary=" + boundary}
+    released = []
+
+    async def failing_delete(deleted_key):
+        released.append(Blob.query.get(key).refs)
+        # Uploads of the content wait until it is deleted
+        with pytest.raises(StorageError):
+            store_content(key, io.BytesIO(content), "image/gif")
+        db.session.rollback()
+        raise S3Error(503, "SlowDown")
+
+    async def scenario():
+        status, _, _ = await asgi_request(asgi_app, "POST", "/api/upload", upload_headers, body)
+        assert status == 200
+        image = Image.query.filter_by(blob_digest=key).one()
+        path = "/api" + schemas["image"].format(user_id=image.user_id, image_id=image.id)
+        s3.delete_object = failing_delete
+        status, _, data = await asgi_request(asgi_app, "DELETE", path, authorization)
+        assert (status, json.loads(data)) == (400, {"aws_error": "SlowDown"})
+        await s3.close()
+        return image.id
+
+    try:
+        image_id = asyncio.run(scenario())
+    finally:
+        server.stop()
+    assert released == [0]
+    assert Image.query.get(image_id) is not None
+    assert Blob.query.get(key).refs == 1
+    assert key in server.objects
+
+
+def test_async_s3_timeouts_and_retries():
+    replies = [None, b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n",
+               b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"]
+    requests = []
+
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        requests.append(reader)
+        reply = replies.pop(0) if replies else None
+        if reply is None:
+            # Stall without answering
+            await asyncio.sleep(5)
+        else:
+            writer.write(reply)
+            await writer.drain()
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        url = "http://127.0.0.1:{}".format(server.sockets[0].getsockname()[1])
+        s3 = AsyncS3Client(None, url, "us-east-1", BUCKET, 1, read_timeout=0.2, max_attempts=3)
+        s3.backoff = ExponentialBackoff(max_backoff=0)
+        # A stall and an error are retried
+        await s3.delete_object("key")
+        assert len(requests) == 3
+        # A stall holding the only connection slot doesn't block the other requests forever
+        replies.extend([None, None])
+        s3.max_attempts = 2
+        with pytest.raises(TimeoutError):
+            await s3.delete_object("key")
+        replies.append(b"HTTP/1.1 404 Not Found\r\nContent-Length: 37\r\n\r\n<Error><Code>NoSuchKey</Code></Error>")
+        with pytest.raises(S3Error) as error:
+            await s3.delete_object("key")
+        assert error.value.code == "NoSuchKey"
+        assert len(requests) == 6
+        # Invalid responses are answered as a bad gateway, and retried as such
+        replies.extend([b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n"] * 2)
+        with pytest.raises(S3Error) as error:
+            await s3.delete_object("key")
+        assert error.value.code == "MalformedResponse"
+        server.close()
+
+    asyncio.run(scenario())
+
+    path_style = AsyncS3Client(None, "http://127.0.0.1:9000", "us-east-1", BUCKET, 1)
+    assert path_style.base_url == "http://127.0.0.1:9000/{}/".format(BUCKET)
+    virtual = AsyncS3Client(None, "https://s3.amazonaws.com", "us-east-1", BUCKET, 1, virtual_host=True)
+    assert (virtual.host, virtual.port) == (BUCKET + ".s3.amazonaws.com", 443)
+    assert virtual.base_url == "https://{}.s3.amazonaws.com/".format(BUCKET)
+
+
+@pytest.mark.actions
+def test_raw_image(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_cache, "directory", str(tmp_path))
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = unique_image()
+    key = hashlib.sha256(content).hexdigest()
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["raw"], "image": [(io.BytesIO(content), "1.gif")]},
+        headers=headers,
+        follow_redirects=True
+    )
+    path = "api" + response.json["images"][0]["_links"]["self"]["href"]
+    image = client.get(path, headers=headers, follow_redirects=True).json
+    raw = "api" + image["_links"]["raw"]["href"]
+
+    # Streamed from S3, then served from the cache
+    misses, hits = image_cache.misses, image_cache.hits
+    for _ in range(2):
+        response = client.get(raw, headers=headers, follow_redirects=True)
+        assert response.status_code == 200
+        assert response.data == content
+        assert response.mimetype == "image/gif"
+    assert (image_cache.misses, image_cache.hits) == (misses + 1, hits + 1)
+
+    response = client.get(raw, headers={**headers, "Range": "bytes=0-5"}, follow_redirects=True)
+    assert response.status_code == 206
+    assert response.data == content[:6]
+    assert response.headers["Content-Range"] == "bytes 0-5/{}".format(len(content))
+    response = client.get(raw, headers={**headers, "If-None-Match": response.headers["ETag"]},
+                          follow_redirects=True)
+    assert response.status_code == 304
+
+    # Ranges of uncached images are requested to S3 and not cached
+    image_cache.discard(key)
+    response = client.get(raw, headers={**headers, "Range": "bytes=6-9"}, follow_redirects=True)
+    assert response.status_code == 206
+    assert response.data == content[6:10]
+    assert image_cache.get(key) is None
+    response = client.get(raw, headers={**headers, "Range": "bytes=1000-2000"}, follow_redirects=True)
+    assert response.status_code == 416
+
+    client.get(raw, headers=headers, follow_redirects=True)
+    client.delete(path, headers=headers, follow_redirects=True)
+    assert image_cache.get(key) is None
+    response = client.get(raw, headers=headers, follow_redirects=True)
+    assert response.status_code == 404
+
+
+def test_asgi_streams_wsgi_fallback(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_cache, "directory", str(tmp_path))
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = IMAGE_FILE + os.urandom(300 * 1024)
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["streamed"], "image": [(io.BytesIO(content), "1.gif")]},
+        headers=headers,
+        follow_redirects=True
+    )
+    image = client.get("api" + response.json["images"][0]["_links"]["self"]["href"], headers=headers,
+                       follow_redirects=True).json
+    asgi_app = AsyncApi(client.application, StandInS3())
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "server": ("127.0.0.1", 80),
+        "path": "/api" + image["_links"]["raw"]["href"], "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"127.0.0.1"), (b"authorization", headers["Authorization"].encode())],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    assert messages[0]["status"] == 200
+    # The raw image is sent as it is read rather than buffered
+    bodies = messages[1:]
+    assert len(bodies) > 2
+    assert all(message["more_body"] for message in bodies[:-1]) and not bodies[-1].get("more_body", False)
+    assert b"".join(message["body"] for message in bodies) == content
+
+    # Large request bodies are spooled to disk
+    chunks = [{"type": "http.request", "body": b"x" * 256 * 1024, "more_body": True}] * 3 + [
+        {"type": "http.request", "body": b""}]
+
+    async def spool():
+        body = await read_body(lambda: asyncio.sleep(0, chunks.pop(0)), 1024 * 1024)
+        with body:
+            assert body._rolled
+            assert body.read() == b"x" * 768 * 1024
+        assert await read_body(lambda: asyncio.sleep(0, {"type": "http.request", "body": b"x" * 10}), 5) is None
+
+    asyncio.run(spool())
+
+
+def test_blob_cache_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), 10)
+    for used_at, key in enumerate(("first", "second")):
+        temp = cache.temp_path(key)
+        with open(temp, "wb") as fp:
+            fp.write(b"12345")
+        cache.commit(temp, key)
+        os.utime(cache.path(key), (used_at, used_at))
+    assert cache.get("first") is not None
+    temp = cache.temp_path("third")
+    with open(temp, "wb") as fp:
+        fp.write(b"12345")
+    cache.commit(temp, "third")
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+
+
+@pytest.mark.actions
+def test_local_storage(client, tmp_path, monkeypatch):
+    local = LocalStorage(str(tmp_path))
+    for module in ("webapp.api.routes", "webapp.storage"):
+        monkeypatch.setattr(sys.modules[module], "storage", local)
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = unique_image()
+    response = client.post(
+        "api/upload",
+        data={"title": "local", "image": (io.BytesIO(content), "1.gif")},
+        headers=headers,
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    image = Image.query.filter_by(title="local").first()
+    key = image.key
+    assert open(local.path(key), "rb").read() == content
+    assert os.path.dirname(local.path(key)) == os.path.join(str(tmp_path), key[:2], key[2:4])
+
+    path = "api/user/{}/image/{}".format(image.user_id, image.id)
+    response = client.get(path, headers=headers, follow_redirects=True)
+    assert response.json["url"] == response.json["_links"]["raw"]["href"]
+    response = client.get(path + "/raw", headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert response.data == content
+    response = client.get(path + "/raw", headers={**headers, "Range": "bytes=2-4"}, follow_redirects=True)
+    assert response.status_code == 206
+    assert response.data == content[2:5]
+    stored = local.get(key, "bytes=2-4")
+    assert b"".join(stored) == content[2:5]
+    assert stored.content_range == "bytes 2-4/{}".format(len(content))
+    stored.close()
+
+    response = client.post("api/upload/presigned", data={"title": "local", "content_type": "image/gif", "size": 10},
+                           headers=headers, follow_redirects=True)
+    assert response.status_code == 501
+
+    response = client.delete(path, headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert local.head(key) is None
+
+
+@pytest.mark.actions
+def test_duplicate_uploads_share_content(client):
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = unique_image()
+    digest = hashlib.sha256(content).hexdigest()
+    bucket = boto3.resource("s3").Bucket(BUCKET)
+    client.post("api/upload", data={"title": "first copy", "image": (io.BytesIO(content), "1.gif")},
+                headers=headers, follow_redirects=True)
+    response = client.post(
+        "api/upload/batch",
+        data={"title": ["second copy", "third copy"],
+              "image": [(io.BytesIO(content), "2.gif"), (io.BytesIO(content), "3.gif")]},
+        headers=headers,
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+    images = Image.query.filter(Image.title.in_(["first copy", "second copy", "third copy"])).all()
+    assert {image.key for image in images} == {digest}
+    assert Blob.query.get(digest).refs == 3
+    assert [item.key for item in bucket.objects.filter(Prefix=digest)] == [digest]
+
+    # The content is deleted with the last image referencing it
+    response = client.delete("api/user/3/image/{}".format(images[0].id), headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert Blob.query.get(digest).refs == 2
+    assert bucket.Object(digest).get()["Body"].read() == content
+    response = client.delete("api/user/3/images", query_string={"id": [image.id for image in images[1:]]},
+                             headers=headers, follow_redirects=True)
+    assert response.json == {"deleted": 2, "errors": []}
+    assert Blob.query.get(digest) is None
+    assert list(bucket.objects.filter(Prefix=digest)) == []
+
+
+@pytest.mark.actions
+def test_derivatives(client, monkeypatch):
+    from PIL import Image as Picture
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = io.BytesIO()
+    Picture.new("RGB", (1200, 600 + uuid.uuid4().int % 100), "teal").save(content, "PNG")
+    content = content.getvalue()
+    response = client.post("api/upload", data={"title": "derived", "image": (io.BytesIO(content), "1.png")},
+                           headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    derivatives.join()
+
+    image = Image.query.filter_by(title="derived").first()
+    path = "api/user/{}/image/{}".format(image.user_id, image.id)
+    response = client.get(path, headers=headers, follow_redirects=True)
+    assert (response.json["width"], response.json["size"]) == (1200, len(content))
+    assert {"thumbnail", "medium", "webp"} <= response.json["_links"].keys()
+    response = client.get("api/user/3", query_string={"limit": 200}, headers=headers, follow_redirects=True)
+    listed = [item for item in response.json["images"] if item["id"] == image.id][0]
+    assert listed["height"] == image.height
+    assert listed["_links"]["thumbnail"]["href"] == "/user/3/image/{}/raw/thumbnail".format(image.id)
+
+    for name, size, mimetype in (("thumbnail", 160, "image/png"), ("medium", 800, "image/png"),
+                                 ("webp", 1200, "image/webp")):
+        response = client.get("{}/raw/{}".format(path, name), headers=headers, follow_redirects=True)
+        assert response.status_code == 200
+        assert response.mimetype == mimetype
+        assert Picture.open(io.BytesIO(response.data)).size[0] == size
+    response = client.get(path + "/raw/huge", headers=headers, follow_redirects=True)
+    assert response.status_code == 404
+
+    # The derivatives are deleted with the content, one that can't be is left behind without failing the delete
+    key = image.key
+    delete = storage.delete
+
+    def failing_delete(deleted_key):
+        if deleted_key.endswith("-thumbnail"):
+            raise StorageError("AccessDenied")
+        delete(deleted_key)
+
+    monkeypatch.setattr(storage, "delete", failing_delete)
+    response = client.delete(path, headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert Image.query.get(image.id) is None
+    assert [item.key for item in boto3.resource("s3").Bucket(BUCKET).objects.filter(Prefix=key)] == [
+        key + "-thumbnail"]
+
+
+@pytest.mark.actions
+def test_presigned_upload_derivatives(client):
+    from PIL import Image as Picture
+    headers = {"Authorization": "Bearer " + oauth_token_password}
+    content = io.BytesIO()
+    Picture.new("RGB", (1200, 600), "olive").save(content, "PNG")
+    content = content.getvalue()
+    response = client.post("api/upload/presigned", data={"title": "direct derived", "content_type": "image/png",
+                                                         "size": len(content)}, headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    upload = response.json
+    bucket = boto3.resource("s3").Bucket(BUCKET)
+    bucket.put_object(Body=content, Key=upload["guid"], ContentType="image/png")
+    response = client.post("api" + upload["_links"]["complete"]["href"], headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    derivatives.join()
+
+    # Direct uploads are stored under their guid, the derivatives are listed on the image
+    path = "api" + upload["_links"]["self"]["href"]
+    response = client.get(path, headers=headers, follow_redirects=True)
+    assert (response.json["width"], response.json["height"], response.json["size"]) == (1200, 600, len(content))
+    assert {"thumbnail", "medium", "webp"} <= response.json["_links"].keys()
+    image_id = int(response.json["id"])
+    response = client.get("api/user/3", query_string={"limit": 1, "before": encode_cursor(image_id + 1)},
+                          headers=headers, follow_redirects=True)
+    assert int(response.json["images"][0]["id"]) == image_id
+    assert "thumbnail" in response.json["images"][0]["_links"]
+    response = client.get(path + "/raw/thumbnail", headers=headers, follow_redirects=True)
+    assert response.status_code == 200
+    assert Picture.open(io.BytesIO(response.data)).size == (160, 80)
+
+    response = client.delete("api/user/3/images", query_string={"id": [image_id]}, headers=headers,
+                             follow_redirects=True)
+    assert response.json == {"deleted": 1, "errors": []}
+    assert list(bucket.objects.filter(Prefix=upload["guid"])) == []
+
+
+def test_benchmark_suite(client):
+    dataset = Dataset(oauth_token_password, [3], [TEST_USER_CREDENTIALS["username"]], [])
+    selected = [(name, make) for name, make in scenarios(dataset) if name in ("GET /api/users", "GET /api/user/<id>")]
+    results = {"client": run(client_driver(client.application), selected, 20, 4)}
+    assert set(results["client"]) == {"GET /api/users", "GET /api/user/<id>"}
+    summary = results["client"]["GET /api/users"]
+    assert summary["throughput"] > 0
+    assert summary["p50"] <= summary["p95"] <= summary["p99"]
+
+    assert summarize([0.001 * n for n in range(1, 101)], 2.0) == pytest.approx(
+        {"throughput": 50.0, "p50": 50.0, "p95": 95.0, "p99": 99.0})
+    assert compare(results, results, 0.1) == []
+    faster = {"client": {"GET /api/users": {**summary, "throughput": summary["throughput"] * 2,
+                                            "p95": summary["p95"] / 2}}}
+    regressions = compare(results, faster, 0.1)
+    assert len(regressions) == 2
+    assert all(regression.startswith("client GET /api/users") for regression in regressions)
+
+
+def test_generate_dataset(client, tmp_path, monkeypatch):
+    local = LocalStorage(str(tmp_path))
+    for module in ("webapp.api.routes", "webapp.storage", "webapp.dataset"):
+        monkeypatch.setattr(sys.modules[module], "storage", local)
+    prefix = generate(20, 100, 200, contents=5, password="generated", batch_size=30, populate=True, workers=4, seed=1)
+
+    users = User.query.filter(User.username.like(prefix + "-%")).all()
+    assert len(users) == 20
+    assert len({user.password for user in users}) == 1
+    images = Image.query.filter(Image.user_id.in_([user.id for user in users])).all()
+    assert len(images) == 100
+    blobs = Blob.query.filter(Blob.digest.in_({image.blob_digest for image in images})).all()
+    assert len(blobs) == 5
+    assert sum(blob.refs for blob in blobs) == 100
+    for blob in blobs:
+        assert hashlib.sha256(open(local.path(blob.digest), "rb").read()).hexdigest() == blob.digest
+
+    tokens = OAuth2Token.query.filter(OAuth2Token.user_id.in_([user.id for user in users])).all()
+    assert len(tokens) == 200
+    now = time.time()
+    assert any(token.get_expires_at() < now for token in tokens)
+    assert any(token.get_expires_at() > now and not token.revoked for token in tokens)
+    assert any(token.revoked for token in tokens)
+
+    # The generated rows are served as uploaded ones
+    response = client.post("api/login", data={"username": users[0].username, "password": "generated"},
+                           follow_redirects=True)
+    assert response.status_code == 200
+    image = images[0]
+    response = client.get("api/user/{}/image/{}/raw".format(image.user_id, image.id),
+                          headers={"Authorization": "Bearer " + oauth_token_password}, follow_redirects=True)
+    assert response.status_code == 200
+    assert hashlib.sha256(response.data).hexdigest() == image.blob_digest
+
+    # Datasets the generator can't build are refused before inserting anything
+    runner = client.application.test_cli_runner()
+    for args, hint in ((["--users", "0", "--tokens", "5"], "--users"), (["--contents", "0"], "--contents")):
+        result = runner.invoke(args=["generate-dataset"] + args)
+        assert result.exit_code == 2
+        assert hint in result.output
+    result = runner.invoke(args=["generate-dataset", "--users", "2", "--images", "3", "--tokens", "4",
+                                 "--contents", "1", "--seed", "1"])
+    assert result.exit_code == 0
+    assert result.output.startswith("Generated 2 users")
@@ -1,52 +1,114 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import sqlite3
 import time
 
+import click
 from flask import request, redirect
 from flask_sqlalchemy import event
-from sqlalchemy import func
 from sqlalchemy.engine import Engine
 
 from webapp.api.model import User
 from webapp.auth.model import OAuth2Client
 from webapp.auth.oauth2 import config_oauth
+from webapp.auth.sweeper import sweeper, sweep_expired
 from .modules import (
     app, db, config, schemas, redirect_uri, client_uri
 )
-from passlib.hash import pbkdf2_sha256 as sha256
 from .apis import api
+from .dataset import generate
+from .migrations import migrate
+from .storage import expire_pending_uploads
+from .spool import spooler
+from .util import HashingRequest
 
 
 def create_app():
     """ Configure db and auth """
+    # Uploaded files are hashed while they are received, to deduplicate their content
+    app.request_class = HashingRequest
     db.init_app(app)
     config_oauth(app)
     api.init_app(app)
+    if config["write_behind"]:
+        spooler.start()
+    sweeper.start()
     return app
 
 
-def init_auth_db():
-    db.drop_all()
-    db.create_all()
+def bootstrap():
+    """ Create or update the schema and seed the developer clients that are missing, returns the clients seeded """
+    migrate()
+    seeded = []
     client_id = "documentation"
-    init_developer_client(dev_username=client_id,
-                          dev_password=client_id,
-                          client_id=client_id,
-                          grants=["password", "authorization_code"],
-                          response_types=["code"],
-                          auth_method="client_secret_basic")
+    seeded += init_developer_client(dev_username=client_id,
+                                    dev_password=client_id,
+                                    client_id=client_id,
+                                    grants=["password", "authorization_code"],
+                                    response_types=["code"],
+                                    auth_method="client_secret_basic")
     client_id = "dummy"
-    init_developer_client(dev_username=client_id,
-                          dev_password=client_id,
-                          client_id=client_id,
-                          grants=["implicit"],
-                          response_types=["token"],
-                          auth_method="none")
-
-
-@app.before_first_request
-def create_table():
-    init_auth_db()
+    seeded += init_developer_client(dev_username=client_id,
+                                    dev_password=client_id,
+                                    client_id=client_id,
+                                    grants=["implicit"],
+                                    response_types=["token"],
+                                    auth_method="none")
+    return seeded
+
+
+@app.cli.command("bootstrap")
+def bootstrap_db():
+    """ Prepare the database, run once per deployment before starting the workers """
+    print("Seeded clients {}".format(bootstrap() or "none"))
+
+
+@app.cli.command("migrate")
+def migrate_db():
+    """ Bring an existing database up to date with the models """
+    print("Applied migrations {}".format(migrate() or "none"))
+
+
+@app.cli.command("sweep-tokens")
+def sweep_tokens():
+    """ Remove the expired or revoked tokens and the expired authorization codes """
+    print("Removed {tokens} tokens and {codes} authorization codes".format(**sweep_expired()))
+
+
+@app.cli.command("expire-uploads")
+def expire_uploads():
+    """ Remove the presigned uploads that were never completed """
+    print("Removed {} expired uploads".format(expire_pending_uploads()))
+
+
+@app.cli.command("generate-dataset")
+@click.option("--users", default=1000, type=click.IntRange(min=0), help="Users inserted, sharing one password")
+@click.option("--images", default=10000, type=click.IntRange(min=0), help="Images inserted, spread over the users")
+@click.option("--tokens", default=10000, type=click.IntRange(min=0),
+              help="OAuth tokens inserted, issued over the last 30 days")
+@click.option("--contents", default=100, type=click.IntRange(min=0), help="Distinct contents shared by the images")
+@click.option("--password", default="password", help="Password of the users")
+@click.option("--batch-size", default=10000, type=click.IntRange(min=1),
+              help="Rows inserted per statement and transaction")
+@click.option("--populate", is_flag=True, help="Write the contents to the storage")
+@click.option("--workers", default=8, type=click.IntRange(min=1), help="Threads writing the contents")
+@click.option("--seed", type=int, help="Seed of the random distributions")
+def generate_dataset(users, images, tokens, contents, password, batch_size, populate, workers, seed):
+    """ Insert a synthetic dataset for scale testing """
+    if (images or tokens) and not users:
+        raise click.BadParameter("images and tokens need at least one user", param_hint="--users")
+    if images and not contents:
+        raise click.BadParameter("images need at least one content", param_hint="--contents")
+    prefix = generate(users, images, tokens, contents, password, batch_size=batch_size, populate=populate,
+                      workers=workers, seed=seed)
+    print("Generated {} users named {}-<number>, {} images and {} tokens".format(users, prefix, images, tokens))
+
+
+# Start the spool workers of the worker processes forked after create_app, which don't inherit them
+@app.before_request
+def start_spooler():
+    if config["write_behind"]:
+        spooler.start()
 
 
 # Redirect HTTP to HTTPS when running in production
@@ -60,21 +122,32 @@ def before_request():
         return redirect(url, code=307)
 
 
-# Enable foreign key constraints checking
+# Enable foreign key constraints checking and tune SQLite for concurrent workers
 @event.listens_for(Engine, "connect")
 def _set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON;")
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.execute("PRAGMA busy_timeout={};".format(int(config["sqlite_busy_timeout_ms"])))
+    cursor.execute("PRAGMA mmap_size={};".format(int(config["sqlite_mmap_size"])))
+    cursor.execute("PRAGMA cache_size=-{};".format(int(config["sqlite_cache_size_kb"])))
     cursor.close()
 
 
 def init_developer_client(dev_username, dev_password, client_id, grants, response_types, auth_method):
-    """ Initialize a developer user with the related client"""
-    new_user = User(username=dev_username,
-                    password=sha256.hash(dev_password))
-    db.session.add(new_user)
-    db.session.commit()
-    new_id = db.session.query(func.max(User.id)).scalar()
+    """ Initialize a developer user with the related client, unless the client exists already """
+    if OAuth2Client.query.filter_by(client_id=client_id).first() is not None:
+        return []
+    new_user = User.query.filter_by(username=dev_username).first()
+    if new_user is None:
+        new_user = User(username=dev_username,
+                        password=User.generate_hash(dev_password))
+        db.session.add(new_user)
+        db.session.commit()
+    new_id = new_user.id
     client_id_issued_at = int(time.time())
 
     client = OAuth2Client(
@@ -98,3 +171,4 @@ def init_developer_client(dev_username, dev_password, client_id, grants, respons
     client.set_client_metadata(client_metadata)
     db.session.add(client)
     db.session.commit()
+    return [client_id]
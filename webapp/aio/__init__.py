@@ -0,0 +1,8 @@
+from webapp import create_app
+from .app import AsyncApi, AsyncSession
+from .s3 import AsyncS3Client, S3Error
+
+
+def create_asgi_app():
+    """ Configure the app and serve it through asyncio """
+    return AsyncApi(create_app())
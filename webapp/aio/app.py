@@ -0,0 +1,338 @@
+import asyncio
+import json
+import re
+import sys
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from authlib.oauth2 import OAuth2Error
+from authlib.oauth2.rfc6749.wrappers import HttpRequest
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.datastructures import Headers
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
+from webapp.api.model import Image, Blob
+from webapp.api.routes import ImageUpload
+from webapp.auth.oauth2 import require_oauth
+from webapp.derivatives import derivatives
+from webapp.modules import config, db, schemas, max_upload_length
+from webapp.spool import spooler
+from webapp.storage import storage, S3Storage, derivative_key
+from webapp.util import (
+    sniff_mimetype, stream_size, check_size_type, invalidate_user, image_cache, hashing_stream_factory, content_digest,
+    image_dimensions
+)
+from .s3 import AsyncS3Client, S3Error
+
+
+class AsyncSession:
+    """ Runs the ORM work of the event loop on as many threads as the database pool has connections """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _call(self, f, args):
+        with self.app.app_context():
+            return f(*args)
+
+    async def run(self, f, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, f, args)
+
+
+# Request bodies larger than this are spooled to a temporary file, as werkzeug does for the uploaded files
+BODY_MEMORY = 512 * 1024
+
+
+async def read_body(receive, limit):
+    """ File with the request body, rewound, None if the body exceeds the limit """
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_MEMORY)
+    size = 0
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionResetError("Client disconnected")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > limit:
+                body.close()
+                return None
+            body.write(chunk)
+            if not message.get("more_body", False):
+                body.seek(0)
+                return body
+    except BaseException:
+        body.close()
+        raise
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The body is complete, even when the client sent it without Content-Length
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+class AsyncApi:
+    """ ASGI application serving the uploads and deletes of the API without blocking a thread on S3.
+    The other routes, and all of them when the storage isn't S3, are served by the Flask app on the database threads """
+
+    def __init__(self, app, s3=None):
+        self.app = app
+        self.db = AsyncSession(app, config["db_pool_size"])
+        self._s3 = s3
+        self.routes = [] if not isinstance(storage, S3Storage) else [
+            ("POST", re.compile("^/api{}/?$".format(schemas["upload"])), self.upload),
+            ("DELETE", re.compile("^/api{}/?$".format(schemas["image"].format(
+                user_id="(?P<user_id>[^/]+)", image_id="(?P<image_id>[^/]+)"))), self.delete),
+        ]
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = AsyncS3Client.create(config)
+        return self._s3
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        for method, pattern, handler in self.routes:
+            match = pattern.match(scope["path"])
+            if scope["method"] == method and match:
+                headers = Headers([(name.decode("latin-1"), value.decode("latin-1"))
+                                   for name, value in scope["headers"]])
+                redirect = self.redirect(scope, headers)
+                if redirect is not None:
+                    return await self.respond(send, redirect)
+                return await self.respond(send, await handler(scope, receive, headers, **match.groupdict()))
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._s3 is not None:
+                    await self._s3.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    def redirect(scope, headers):
+        """ Redirect HTTP to HTTPS when running in production, as the Flask app does """
+        url = "{}://{}{}".format(scope.get("scheme", "http"), headers.get("Host", ""), scope["path"])
+        if (
+                not url.startswith("http://127.0.0.1") and
+                not url.startswith("http://0.0.0.0") and
+                scope.get("scheme") != "https"):
+            query = scope["query_string"].decode("latin-1")
+            location = url.replace("http://", "https://", 1) + ("?" + query if query else "")
+            return None, 307, {"Location": location}
+        return None
+
+    @staticmethod
+    async def respond(send, result):
+        data, status, headers = (result + ({},))[:3] if isinstance(result, tuple) else (result, 200, {})
+        body = b"" if data is None else (json.dumps(data) + "\n").encode()
+        headers = {**headers, "Content-Length": str(len(body))}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def authenticate(self, scope, headers, scopes):
+        """ The id of the user owning the access token, or the error response of require_oauth """
+        request = HttpRequest(scope["method"], scope["path"], None, headers)
+        try:
+            return await self.db.run(self._validate, request, scopes), None
+        except OAuth2Error as error:
+            return None, (dict(error.get_body()), error.status_code, dict(error.get_headers()))
+
+    @staticmethod
+    def _validate(request, scopes):
+        return require_oauth.validate_request(scopes, request).user.id
+
+    async def upload(self, scope, receive, headers):
+        user_id, error = await self.authenticate(scope, headers, "write")
+        if error is not None:
+            return error
+        too_large = {"message": "Image exceeds the maximum size of {} KB".format(config["max_size_kb"])}, 413
+        content_length = headers.get("Content-Length", type=int)
+        if content_length is not None and content_length > max_upload_length:
+            return too_large
+        body = await read_body(receive, max_upload_length)
+        if body is None:
+            return too_large
+        mimetype, options = parse_options_header(headers.get("Content-Type", ""))
+        with body:
+            _, form, files = FormDataParser(hashing_stream_factory).parse(body, mimetype, stream_size(body), options)
+        if "image" not in files or "title" not in form:
+            return {"message": "Input payload validation failed"}, 400
+        new_image = Image(title=form["title"], user_id=user_id, guid=uuid.uuid4().hex)
+        new_file = files["image"].stream
+        new_type = sniff_mimetype(new_file)
+        new_image.size = stream_size(new_file)
+        if not check_size_type(new_type, new_image.size):
+            return {"success": False}, 400
+        new_image.width, new_image.height = image_dimensions(new_file)
+        if config["write_behind"]:
+            return await self.db.run(ImageUpload.spool, new_image, new_file)
+        new_image.blob_digest = content_digest(new_file)
+        try:
+            if await self.db.run(self._store_duplicate, new_image):
+                return {"success": True}, 200
+        except SQLAlchemyError:
+            return {"success": False}, 400
+        try:
+            await self.s3.put_object(new_image.blob_digest, new_file.read(), new_type)
+        except (S3Error, OSError):
+            return {"message": "Error uploading the image to the storage"}, 400
+        try:
+            await self.db.run(self._store, new_image)
+        except SQLAlchemyError:
+            if not await self.db.run(Blob.exists, new_image.blob_digest):
+                await self.s3.delete_object(new_image.blob_digest)
+            return {"success": False}, 400
+        derivatives.submit(new_image.blob_digest)
+        return {"success": True}, 200
+
+    @staticmethod
+    def _store_duplicate(new_image):
+        """ Commit the image if its content is stored already, returns whether it was """
+        if not (Blob.exists(new_image.blob_digest) and Blob.acquire(new_image.blob_digest)):
+            db.session.rollback()
+            return False
+        db.session.add(new_image)
+        db.session.commit()
+        invalidate_user(new_image.user_id)
+        return True
+
+    @staticmethod
+    def _store(new_image):
+        Blob.reference(new_image.blob_digest)
+        db.session.add(new_image)
+        db.session.commit()
+        invalidate_user(new_image.user_id)
+
+    async def delete(self, scope, receive, headers, user_id, image_id):
+        token_user_id, error = await self.authenticate(scope, headers, "write")
+        if error is not None:
+            return error
+        if user_id != str(token_user_id):
+            return {"success": False}, 401
+        released = await self.db.run(self._release, user_id, image_id)
+        if released is None:
+            return {"success": False}, 404
+        guid, digest, keys = released
+        if keys:
+            # The content is deleted on the event loop, without holding a database thread
+            try:
+                await self.s3.delete_object(keys[0])
+            except (S3Error, OSError) as e:
+                await self.db.run(self._restore, digest)
+                return {"aws_error": e.code if isinstance(e, S3Error) else type(e).__name__}, 400
+            for key in keys[1:]:
+                try:
+                    await self.s3.delete_object(key)
+                except (S3Error, OSError):
+                    self.app.logger.exception("Error deleting the derivative %s", key)
+            await self.db.run(self._remove, user_id, image_id, guid, digest, keys)
+        return {"success": True}
+
+    @classmethod
+    def _release(cls, user_id, image_id):
+        """ Drop the reference of the image on its content and commit, returns the guid and digest of the image and
+        the keys to delete from the storage, None if the image doesn't exist. The image is removed at once when other
+        images share its content, otherwise once the content is deleted: meanwhile its blob is kept without references,
+        so that uploads of the same content don't take it """
+        image = Image.query.filter_by(id=image_id, user_id=user_id).first()
+        if image is None:
+            return None
+        guid, digest, key = image.guid, image.blob_digest, image.key
+        if digest is not None and not Blob.release(digest):
+            cls._remove(user_id, image_id, guid, digest, [])
+            return guid, digest, []
+        names = image.derivative_names
+        db.session.commit()
+        return guid, digest, [key] + [derivative_key(key, name) for name in names]
+
+    @staticmethod
+    def _restore(digest):
+        """ Take back the reference of an image whose content couldn't be deleted """
+        if digest is not None:
+            Blob.restore(digest)
+        db.session.commit()
+
+    @staticmethod
+    def _remove(user_id, image_id, guid, digest, deleted):
+        Image.query.filter_by(id=image_id).delete()
+        if digest is not None:
+            Blob.remove_unreferenced([digest])
+        db.session.commit()
+        invalidate_user(user_id)
+        spooler.discard(guid)
+        for key in deleted:
+            image_cache.discard(key)
+
+    async def wsgi(self, scope, receive, send):
+        body = await read_body(receive, self.app.config["MAX_CONTENT_LENGTH"])
+        if body is None:
+            return await self.respond(send, ({"message": "Request entity too large"}, 413))
+        loop = asyncio.get_running_loop()
+        with body:
+            status, headers, result = await loop.run_in_executor(
+                self.db.executor, self._call_wsgi, wsgi_environ(scope, body))
+            try:
+                await send({"type": "http.response.start", "status": status,
+                            "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+                # Streamed responses, such as the raw images, are read chunk by chunk off the database threads
+                chunks = iter(result)
+                while True:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(result, "close"):
+                    await loop.run_in_executor(None, result.close)
+
+    def _call_wsgi(self, environ):
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = headers
+
+        result = self.app.wsgi_app(environ, start_response)
+        return response["status"], response["headers"], result
@@ -0,0 +1,203 @@
+import asyncio
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.retries.standard import ExponentialBackoff, RetryContext
+from botocore.utils import check_dns_name
+
+# Errors botocore's standard retry mode retries, the transport errors are retried as well
+RETRYABLE_STATUS = {500, 502, 503, 504}
+RETRYABLE_CODES = {"RequestTimeout", "RequestTimeoutException", "PriorRequestNotComplete", "SlowDown", "Throttling",
+                   "ThrottlingException", "RequestLimitExceeded", "BandwidthLimitExceeded"}
+# The object requests are answered with an empty body or a short XML document
+MAX_RESPONSE_SIZE = 1024 * 1024
+
+
+class S3Error(Exception):
+    def __init__(self, status, code):
+        super().__init__("S3 replied {} {}".format(status, code))
+        self.status = status
+        self.code = code
+
+
+class AsyncS3Client:
+    """ Non-blocking S3 client, requests are signed by botocore and sent on pooled asyncio connections.
+    Each step of a request is bounded by the timeouts of the boto3 client, and failed requests are retried with the
+    attempts and backoff of botocore's standard retry mode """
+
+    def __init__(self, credentials, endpoint_url, region, bucket, max_connections, connect_timeout=60,
+                 read_timeout=60, max_attempts=3, virtual_host=False):
+        self.credentials = credentials
+        self.region = region
+        self.bucket = bucket
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.backoff = ExponentialBackoff()
+        split = urlsplit(endpoint_url.rstrip("/"))
+        self.secure = split.scheme == "https"
+        self.host = "{}.{}".format(bucket, split.hostname) if virtual_host else split.hostname
+        self.port = split.port or (443 if self.secure else 80)
+        # Virtual-hosted style addresses the bucket by the host name, path style by the first segment of the path
+        self.base_url = "{}://{}{}{}".format(split.scheme, self.host, ":{}".format(split.port) if split.port else "",
+                                             split.path + "/" + ("" if virtual_host else bucket + "/"))
+        self._loop = None
+        self._idle = []
+        self._slots = None
+
+    @classmethod
+    def create(cls, settings):
+        """ Client with the credentials, endpoint, region and addressing style boto3 would use """
+        import boto3
+        session = boto3.session.Session()
+        client = session.client("s3", endpoint_url=settings["s3_endpoint_url"])
+        bucket = settings["bucket_name"]
+        # As the "auto" addressing style of botocore: path style for custom endpoints and bucket names that can't be
+        # a host name of the certificate of S3
+        virtual_host = settings["s3_endpoint_url"] is None and check_dns_name(bucket) and "." not in bucket
+        return cls(session.get_credentials(), client.meta.endpoint_url, client.meta.region_name, bucket,
+                   settings["s3_max_pool_connections"], settings["s3_connect_timeout"], settings["s3_read_timeout"],
+                   settings["s3_max_attempts"], virtual_host)
+
+    async def put_object(self, key, body, content_type, acl="public-read"):
+        await self.request("PUT", key, body, {"Content-Type": content_type, "x-amz-acl": acl})
+
+    async def delete_object(self, key):
+        await self.request("DELETE", key)
+
+    async def request(self, method, key, body=b"", headers=None):
+        """ Send a request for the key of the bucket, raises S3Error when S3 doesn't accept it and OSError when it
+        can't be reached, once the attempts are exhausted """
+        message = self._message(method, key, body, headers or {})
+        self._bind()
+        attempt = 1
+        while True:
+            try:
+                async with self._slots:
+                    status, response_headers, data = await self._send(message, method)
+                if status < 300:
+                    return status, response_headers, data
+                raise S3Error(status, self._error_code(status, data))
+            except (S3Error, OSError) as e:
+                retryable = not isinstance(e, S3Error) or e.status in RETRYABLE_STATUS or e.code in RETRYABLE_CODES
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+            # The backoff doesn't hold a connection slot
+            await asyncio.sleep(self.backoff.delay_amount(RetryContext(attempt)))
+            attempt += 1
+
+    @staticmethod
+    def _error_code(status, data):
+        try:
+            return ElementTree.fromstring(data).findtext("Code") or str(status)
+        except ElementTree.ParseError:
+            return str(status)
+
+    async def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+    def _bind(self):
+        # Connections and the semaphore belong to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._idle = []
+            self._slots = asyncio.Semaphore(self.max_connections)
+
+    def _message(self, method, key, body, headers):
+        request = AWSRequest(method=method, url=self.base_url + quote(key),
+                             data=body, headers=headers)
+        if self.credentials is not None:
+            S3SigV4Auth(self.credentials.get_frozen_credentials(), "s3", self.region).add_auth(request)
+        prepared = request.prepare()
+        split = urlsplit(prepared.url)
+        lines = ["{} {}{} HTTP/1.1".format(method, split.path, "?" + split.query if split.query else ""),
+                 "Host: {}".format(split.netloc)]
+        lines += ["{}: {}".format(name, value) for name, value in prepared.headers.items()]
+        if "Content-Length" not in prepared.headers:
+            lines.append("Content-Length: {}".format(len(body)))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    @staticmethod
+    async def _timed(awaitable, timeout):
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError as e:
+            raise TimeoutError("S3 didn't answer within {} s".format(timeout)) from e
+
+    async def _send(self, message, method):
+        while True:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else await self._timed(asyncio.open_connection(
+                self.host, self.port, ssl=self.secure or None), self.connect_timeout)
+            try:
+                writer.write(message)
+                await self._timed(writer.drain(), self.read_timeout)
+                status, headers, data = await self._timed(self._read_response(reader, method), self.read_timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                # The server may have closed an idle connection meanwhile, which doesn't count as an attempt
+                if reused:
+                    continue
+                raise ConnectionResetError("Connection to S3 lost") from e
+            except BaseException:
+                writer.close()
+                raise
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self._idle.append((reader, writer))
+            return status, headers, data
+
+    @staticmethod
+    async def _read_response(reader, method):
+        """ Status, headers and body of the response, raises S3Error with a 502 status when it isn't valid HTTP """
+        try:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed by S3")
+            status = int(status_line.split()[1])
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, separator, value = line.decode("latin-1").partition(":")
+                if not separator:
+                    raise ValueError("Malformed header")
+                headers[name.strip().lower()] = value.strip()
+            if method == "HEAD" or status in (204, 304):
+                return status, headers, b""
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = []
+                length = 0
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    length += size
+                    if size < 0 or length > MAX_RESPONSE_SIZE:
+                        raise ValueError("Invalid chunk size")
+                    if size == 0:
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        return status, headers, b"".join(chunks)
+                    chunks.append(await reader.readexactly(size))
+                    if await reader.readexactly(2) != b"\r\n":
+                        raise ValueError("Invalid chunk delimiter")
+            if "content-length" in headers:
+                length = int(headers["content-length"])
+                if not 0 <= length <= MAX_RESPONSE_SIZE:
+                    raise ValueError("Invalid Content-Length")
+                return status, headers, await reader.readexactly(length)
+            headers["connection"] = "close"
+            data = await reader.read(MAX_RESPONSE_SIZE + 1)
+            if len(data) > MAX_RESPONSE_SIZE:
+                raise ValueError("Response too large")
+            return status, headers, data
+        except (ValueError, IndexError) as e:
+            # Includes the lines longer than the limit of the reader
+            raise S3Error(502, "MalformedResponse") from e
@@ -1,4 +1,5 @@
 from flask_restx import fields, Namespace
+from webapp.modules import config
 
 # Define the Namespace for user related routes
 api = Namespace("users", description="Users related operations")
@@ -23,28 +24,80 @@ class Marshaller:
         "_links": fields.Nested(links, skip_none=True)
     })
 
+    links_page = api.clone("Links Page", links, {
+        "next": fields.Nested(self, skip_none=True),
+        "prev": fields.Nested(self, skip_none=True)
+    })
+
     users = api.model("Users", {
         "users": fields.List(fields.Nested(user, skip_none=True)),
-        "_links": fields.Nested(links, skip_none=True)
+        "_links": fields.Nested(links_page, skip_none=True)
     })
 
+    links_derivatives = api.clone("Links Derivatives", links, dict.fromkeys(
+        list(config["derivative_sizes"]) + [config["derivative_format"]], fields.Nested(self, skip_none=True)
+    ))
+
     image = api.model("Image", {
         "id": fields.Integer,
         "title": fields.String,
         "guid": fields.String,
-        "_links": fields.Nested(links, skip_none=True)
+        "width": fields.Integer,
+        "height": fields.Integer,
+        "size": fields.Integer,
+        "_links": fields.Nested(links_derivatives, skip_none=True)
     })
 
     user_images = api.clone("User images", user, {
-        "images": fields.List(fields.Nested(image, skip_none=True))
+        "images": fields.List(fields.Nested(image, skip_none=True)),
+        "_links": fields.Nested(links_page, skip_none=True)
+    })
+
+    links_image = api.clone("Links Image", links_derivatives, {
+        "user": fields.Nested(user_link, skip_none=True),
+        "raw": fields.Nested(self, skip_none=True)
+    })
+
+    batch_item = api.model("Batch Upload Item", {
+        "id": fields.Integer,
+        "title": fields.String,
+        "success": fields.Boolean,
+        "message": fields.String,
+        "_links": fields.Nested(links, skip_none=True)
     })
 
-    links_image = api.clone("Links Image", links, {
-        "user": fields.Nested(user_link, skip_none=True)
+    batch_upload = api.model("Batch Upload", {
+        "images": fields.List(fields.Nested(batch_item, skip_none=True))
+    })
+
+    delete_error = api.model("Delete Error", {
+        "ids": fields.List(fields.Integer),
+        "Key": fields.String,
+        "Code": fields.String,
+        "Message": fields.String
+    })
+
+    bulk_delete = api.model("Bulk Delete", {
+        "deleted": fields.Integer,
+        "errors": fields.List(fields.Nested(delete_error, skip_none=True))
+    })
+
+    links_upload = api.clone("Links Upload", links, {
+        "complete": fields.Nested(self, skip_none=True)
+    })
+
+    presigned_upload = api.model("Presigned Upload", {
+        "id": fields.Integer,
+        "guid": fields.String,
+        "url": fields.String,
+        "fields": fields.Raw,
+        "expires_in": fields.Integer,
+        "_links": fields.Nested(links_upload, skip_none=True)
     })
 
     single_image = api.clone("Single Image", image, {
         "url": fields.String,
+        "status": fields.String(enum=["active", "pending", "failed"]),
         "_links": fields.Nested(links_image, skip_none=True)
     })
 
@@ -1,23 +1,36 @@
+import time
 import uuid
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship
-from passlib.hash import pbkdf2_sha256 as sha256
+from ..hashing import hasher
 from ..modules import db
 
 
+def timestamp():
+    return int(time.time())
+
+
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(120), nullable=False, unique=True, index=True)
     password = db.Column(db.String(120), nullable=False)
+    created_at = db.Column(db.Integer, nullable=False, default=timestamp)
+    updated_at = db.Column(db.Integer, nullable=False, default=timestamp, onupdate=timestamp)
     images = relationship("Image")
 
     @staticmethod
     def generate_hash(password):
-        return sha256.hash(password)
+        return hasher.hash(password)
 
     def check_password(self, password):
-        return sha256.verify(password, self.password)
+        if not hasher.verify(password, self.password):
+            return False
+        # Upgrade the stored hash when it was computed with old parameters
+        if hasher.needs_update(self.password):
+            self.password = hasher.hash(password)
+            db.session.commit()
+        return True
 
     @classmethod
     def exists_by_id(cls, searched_id):
@@ -35,9 +48,112 @@ def generate_guid():
     return uuid.uuid4().hex
 
 
+# Image statuses: reserved images are hidden until their presigned upload is completed,
+# pending images are waiting in the spool to be written to the storage
+ACTIVE = "active"
+RESERVED = "reserved"
+PENDING = "pending"
+FAILED = "failed"
+
+
+class Blob(db.Model):
+    """ Stored content, keyed by its SHA-256 digest and shared by the images with the same bytes """
+    __tablename__ = "blobs"
+    digest = db.Column(db.String(64), primary_key=True)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+    # Names of the derivatives rendered from the content, separated by spaces
+    derivatives = db.Column(db.String(120))
+    created_at = db.Column(db.Integer, nullable=False, default=timestamp)
+
+    @classmethod
+    def exists(cls, digest):
+        return cls.query.filter_by(digest=digest).count() != 0
+
+    @classmethod
+    def existing(cls, digests):
+        digests = list(digests)
+        if not digests:
+            return set()
+        return {row.digest for row in db.session.query(cls.digest).filter(cls.digest.in_(digests))}
+
+    @classmethod
+    def acquire(cls, digest, count=1):
+        """ Take references on the blob, returns False if it doesn't exist or is kept without references while its
+        content is deleted """
+        return cls.query.filter(cls.digest == digest, cls.refs > 0).update(
+            {"refs": cls.refs + count}, synchronize_session=False) == 1
+
+    @classmethod
+    def restore(cls, digest, count=1):
+        """ Take back references released for contents that couldn't be deleted """
+        cls.query.filter_by(digest=digest).update({"refs": cls.refs + count}, synchronize_session=False)
+
+    @classmethod
+    def reference(cls, digest, count=1):
+        """ Take references on the blob of content just written to the storage, creating it if needed """
+        if not cls.acquire(digest, count):
+            db.session.add(cls(digest=digest, refs=count))
+            db.session.flush()
+
+    @classmethod
+    def release(cls, digest, count=1):
+        """ Drop references on the blob, returns whether none is left. The blob row locked by the update is kept until
+        the content is deleted, so that concurrent uploads of the same content wait for it """
+        cls.query.filter_by(digest=digest).update({"refs": cls.refs - count}, synchronize_session=False)
+        return (db.session.query(cls.refs).filter_by(digest=digest).scalar() or 0) <= 0
+
+    @classmethod
+    def derivatives_of(cls, digests):
+        """ Names of the derivatives of each of the blobs """
+        digests = list(digests)
+        if not digests:
+            return dict()
+        rows = db.session.query(cls.digest, cls.derivatives).filter(cls.digest.in_(digests))
+        return {row.digest: (row.derivatives or "").split() for row in rows}
+
+    @classmethod
+    def remove_unreferenced(cls, digests):
+        digests = list(digests)
+        if not digests:
+            return 0
+        return cls.query.filter(cls.digest.in_(digests), cls.refs <= 0).delete(synchronize_session=False)
+
+
 class Image(db.Model):
     __tablename__ = "images"
+    __table_args__ = (
+        # Pages of the images of a user, and lookups of the images of a user
+        db.Index("ix_images_user_id_status_id", "user_id", "status", "id"),
+        # Expiry of the reserved images
+        db.Index("ix_images_status_created_at", "status", "created_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     guid = db.Column(db.String(32), nullable=False, unique=True, index=True, default=generate_guid)
     title = db.Column(db.String(120), nullable=False)
     user_id = db.Column(db.Integer, ForeignKey("users.id"), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=ACTIVE)
+    # Images uploaded before deduplication, and direct uploads, are stored under their guid instead of a blob
+    blob_digest = db.Column(db.String(64), ForeignKey("blobs.digest"))
+    blob = relationship("Blob")
+    # Names of the derivatives of the content stored under the guid, the ones of blobs are listed on the blob
+    derivatives = db.Column(db.String(120))
+    # Dimensions in pixels and size in bytes of the content, to lay out galleries without fetching it
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    size = db.Column(db.Integer)
+    created_at = db.Column(db.Integer, nullable=False, default=timestamp)
+    updated_at = db.Column(db.Integer, nullable=False, default=timestamp, onupdate=timestamp)
+
+    @property
+    def key(self):
+        """ Key of the content in the storage """
+        return self.blob_digest or self.guid
+
+    @property
+    def derivative_names(self):
+        """ Names of the derivatives rendered from the content """
+        return ((self.blob.derivatives if self.blob else self.derivatives) or "").split()
+
+    @classmethod
+    def expired_reserved(cls, cutoff):
+        return cls.query.filter(cls.status == RESERVED, cls.created_at < cutoff)
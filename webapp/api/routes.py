@@ -1,17 +1,31 @@
+import os
+import time
 import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
 
 from authlib.integrations.flask_oauth2 import current_token
-from botocore.exceptions import ClientError
 from flask_restx import Resource
+from sqlalchemy import and_, or_, func
 from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.utils import redirect
-from webapp.api.model import User, Image
-from webapp.modules import schemas, db, config, client_s3
-from webapp.auth.oauth2 import require_oauth
+from webapp.api.model import User, Image, Blob, ACTIVE, RESERVED, PENDING
+from webapp.modules import app, schemas, db, config, max_upload_length, upload_pool
+from webapp.auth.oauth2 import require_oauth, token_cache
+from webapp.derivatives import derivatives
 from webapp.parsers import Parsers
-from webapp.util import UserBuilder, add_self, ImageBuilder, get_mimetype, check_size_type
+from webapp.spool import spooler
+from webapp.storage import (
+    storage, StorageError, store_content, forget_contents, delete_image, derivative_key, stored_dimensions
+)
+from webapp.util import (
+    UserBuilder, add_self, add_link, ImageBuilder, sniff_mimetype, stream_size, check_size_type, Page, add_page_links,
+    validators, not_modified, response_cache, user_namespace, invalidate_user, image_cache, cache_stream, content_digest,
+    image_dimensions, limit_content_length
+)
 from .marshaller import api, Marshaller
-from flask import session
+from flask import session, request, send_file, Response
+from werkzeug.http import is_resource_modified
 
 # Define grants that allows to access the different resources
 security_grants = [{"oauth2_implicit": ["read"]}, {"oauth2_password": ["read write"]}, {"oauth2_code": ["read write"]}]
@@ -22,6 +36,7 @@ class Register(Resource):
     @api.response(200, description="Registration was successful")
     @api.response(400, description="Registration was unsuccessful")
     @api.response(500, description="An internal server error occurred")
+    @api.response(503, description="Too many password operations in progress")
     @api.expect(Parsers.register, validate=True)
     def post(self):
         data = Parsers.register.parse_args()
@@ -32,6 +47,7 @@ class Register(Resource):
         try:
             db.session.add(new_user)
             db.session.commit()
+            response_cache.invalidate("users")
             return {"success": True}, 200
         except Exception:
             return {"success": False}, 500
@@ -40,6 +56,7 @@ class Register(Resource):
 @api.route(schemas["login"])
 @api.response(200, description="Login was successful")
 @api.response(401, description="Login was unsuccessful")
+@api.response(503, description="Too many password operations in progress")
 class Login(Resource):
     @api.expect(Parsers.login, validate=True)
     def post(self):
@@ -56,33 +73,72 @@ class UsersQuery(Resource):
     @api.doc(security=security_grants)
     @require_oauth("read")
     @api.response(200, description="List of users", model=Marshaller.users)
+    @api.response(304, description="List of users wasn't modified")
+    @api.response(400, description="Invalid pagination arguments")
     @api.response(401, description="Unauthorized")
+    @api.expect(Parsers.page, validate=True)
+    @response_cache.cached("users")
     def get(self):
-        users = [UserBuilder(id, username) for id, username in db.session.query(User.id, User.username)]
+        try:
+            page = Page(Parsers.page.parse_args())
+        except ValueError:
+            return {"message": "Invalid pagination arguments"}, 400
+        condition, order = page.bounds(User.id)
+        rows = db.session.query(User.id, User.username, User.updated_at).filter(condition).order_by(order)
+        selected_users = page.slice(rows.limit(page.limit + 1).all(), key=lambda row: row.id)
+        headers = validators(selected_users + [(page.next, page.prev)])
+        unchanged = not_modified(headers)
+        if unchanged is not None:
+            return unchanged
+        users = [UserBuilder(user.id, user.username) for user in selected_users]
         response = dict()
         response["users"] = users
-        add_self(response, schemas["users"])
-        return response
+        add_page_links(response, schemas["users"], page)
+        return response, 200, headers
 
 
 @api.route(schemas["user"].format(id="<user_id>"))
 class ImagesQuery(Resource):
     @api.response(200, description="List of images of the selected user", model=Marshaller.user_images)
+    @api.response(304, description="List of images wasn't modified")
     @api.response(401, description="Unauthorized")
     @api.response(403, description="Forbidden")
     @api.response(404, description="Selected user doesn't exist")
+    @api.response(400, description="Invalid pagination arguments")
     @api.doc(security=security_grants)
     @require_oauth("read")
+    @api.expect(Parsers.page, validate=True)
+    @response_cache.cached(user_namespace)
     def get(self, user_id):
-        if not User.exists_by_id(user_id):
+        try:
+            page = Page(Parsers.page.parse_args())
+        except ValueError:
+            return {"message": "Invalid pagination arguments"}, 400
+        # Load the user and a page of its images at once, a user without images yields a single row
+        condition, order = page.bounds(Image.id)
+        rows = db.session.query(User.username, User.updated_at.label("user_updated_at"),
+                                Image.id, Image.guid, Image.title, Image.updated_at,
+                                Image.width, Image.height, Image.size,
+                                func.coalesce(Blob.derivatives, Image.derivatives).label("derivatives")) \
+            .outerjoin(Image, and_(Image.user_id == User.id, Image.status == ACTIVE, condition)) \
+            .outerjoin(Blob, Blob.digest == Image.blob_digest) \
+            .filter(User.id == user_id) \
+            .order_by(order) \
+            .limit(page.limit + 1) \
+            .all()
+        if not rows:
             return {"message": "User with given name doesn't exist"}, 404
-        selected_user = User.query.filter_by(id=user_id).first()
-        selected_images = Image.query.filter_by(user_id=user_id).all()
-        images = [ImageBuilder(user_id, image.id, image.guid, image.title) for image in selected_images]
-        response = UserBuilder(user_id, selected_user.username)
+        selected_images = page.slice([row for row in rows if row.id is not None], key=lambda row: row.id)
+        headers = validators(rows[:1] + selected_images + [(page.next, page.prev)])
+        unchanged = not_modified(headers)
+        if unchanged is not None:
+            return unchanged
+        images = [ImageBuilder(user_id, image.id, image.guid, image.title, image.width, image.height, image.size,
+                               image.derivatives) for image in selected_images]
+        response = UserBuilder(user_id, rows[0].username)
         response["images"] = images
-        add_self(response, schemas["user"].format(id=user_id))
-        return response
+        add_page_links(response, schemas["user"].format(id=user_id), page)
+        return response, 200, headers
 
 
 @api.route(schemas["upload"])
@@ -90,55 +146,247 @@ class ImageUpload(Resource):
     @api.response(401, description="Unauthorized")
     @api.response(403, description="Forbidden")
     @api.response(400, description="Upload wasn't successful")
+    @api.response(413, description="Image is too large")
     @api.response(200, description="Upload was successful")
+    @api.response(202, description="Upload was accepted and is being written to the storage")
     @api.doc(security=security_grants)
     @api.expect(Parsers.image_upload, validate=True)
+    @limit_content_length(max_upload_length, "Image exceeds the maximum size of {} KB".format(config["max_size_kb"]))
     @require_oauth("write")
     def post(self):
         user_id = current_token.user.id
-        bucket = client_s3.Bucket(config["bucket_name"])
         data = Parsers.image_upload.parse_args()
         new_guid = uuid.uuid4().hex
         new_image = Image(title=data["title"], user_id=user_id, guid=new_guid)
-        new_file = data["image"].read()
-        new_type = get_mimetype(new_file)
-        if not check_size_type(new_type, new_file):
+        new_file = data["image"].stream
+        new_type = sniff_mimetype(new_file)
+        new_image.size = stream_size(new_file)
+        if not check_size_type(new_type, new_image.size):
             return {"success": False}, 400
+        new_image.width, new_image.height = image_dimensions(new_file)
+        if config["write_behind"]:
+            return self.spool(new_image, new_file)
+        # The content is written only once, whoever uploads it
+        new_image.blob_digest = content_digest(new_file)
         try:
-            bucket.put_object(Body=new_file, Key=new_guid, ContentType=new_type, ACL="public-read")
-        except ClientError:
+            written = store_content(new_image.blob_digest, new_file, new_type)
+        except StorageError:
+            db.session.rollback()
             return {"message": "Error uploading the image to the storage"}, 400
         try:
             db.session.add(new_image)
             db.session.commit()
         except SQLAlchemyError:
-            client_s3.Object(config["bucket_name"], new_guid).delete()
+            db.session.rollback()
+            if written:
+                forget_contents([new_image.blob_digest])
             return {"success": False}, 400
+        invalidate_user(user_id)
+        if written:
+            derivatives.submit(new_image.blob_digest)
         return {"success": True}, 200
 
+    @staticmethod
+    def spool(new_image, new_file):
+        """ Accept the upload once durably spooled, it is written to the storage in background """
+        new_image.status = PENDING
+        try:
+            db.session.add(new_image)
+            db.session.commit()
+        except SQLAlchemyError:
+            return {"success": False}, 400
+        try:
+            spooler.spool(new_file, new_image.guid)
+        except OSError:
+            db.session.delete(new_image)
+            db.session.commit()
+            return {"message": "Error spooling the image"}, 400
+        invalidate_user(new_image.user_id)
+        response = {"success": True, "status": PENDING}
+        add_self(response, schemas["image"].format(user_id=new_image.user_id, image_id=new_image.id))
+        return response, 202
+
+
+@api.route(schemas["batch_upload"])
+class BatchUpload(Resource):
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.response(400, description="No image was uploaded")
+    @api.response(413, description="Images are too large")
+    @api.response(200, description="Outcome of the upload of each image", model=Marshaller.batch_upload)
+    @api.doc(security=security_grants)
+    @api.expect(Parsers.batch_upload, validate=True)
+    @require_oauth("write")
+    def post(self):
+        if request.content_length is not None and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+            return {"message": "Images exceed the maximum size of the batch"}, 413
+        user_id = current_token.user.id
+        data = Parsers.batch_upload.parse_args()
+        if len(data["image"]) != len(data["title"]) or len(data["image"]) > config["max_batch_size"]:
+            return {"message": "Up to {} images, each with a title, are allowed".format(config["max_batch_size"])}, 400
+        results = [{"title": title, "success": False} for title in data["title"]]
+        uploads = dict()
+        contents = dict()
+        for index, (new_file, title) in enumerate(zip(data["image"], data["title"])):
+            new_type = sniff_mimetype(new_file.stream)
+            new_size = stream_size(new_file.stream)
+            if not check_size_type(new_type, new_size):
+                results[index]["message"] = "Image type or size not allowed"
+                continue
+            digest = content_digest(new_file.stream)
+            width, height = image_dimensions(new_file.stream)
+            uploads[index] = Image(title=title, user_id=user_id, guid=uuid.uuid4().hex, blob_digest=digest,
+                                   width=width, height=height, size=new_size)
+            contents.setdefault(digest, (new_file.stream, new_type))
+        # Contents stored already, or repeated in the batch, aren't written again
+        existing = Blob.existing(contents)
+        writes = {digest: upload_pool.submit(storage.put, stream, digest, new_type)
+                  for digest, (stream, new_type) in contents.items() if digest not in existing}
+        written = set()
+        for digest, future in writes.items():
+            try:
+                future.result()
+                written.add(digest)
+            except StorageError:
+                pass
+        stored = dict()
+        for index, new_image in uploads.items():
+            if new_image.blob_digest in existing or new_image.blob_digest in written:
+                stored[index] = new_image
+            else:
+                results[index]["message"] = "Error uploading the image to the storage"
+        try:
+            references = Counter(new_image.blob_digest for new_image in stored.values())
+            for digest, count in references.items():
+                if store_content(digest, *contents[digest], count=count, written=digest in written):
+                    written.add(digest)
+            db.session.add_all(stored.values())
+            db.session.commit()
+        except (SQLAlchemyError, StorageError):
+            db.session.rollback()
+            forget_contents(written)
+            for index in stored:
+                results[index]["message"] = "Error saving the image"
+            return {"images": results}, 400
+        invalidate_user(user_id)
+        for digest in written:
+            derivatives.submit(digest)
+        for index, new_image in stored.items():
+            results[index]["id"] = new_image.id
+            results[index]["success"] = True
+            add_self(results[index], schemas["image"].format(user_id=user_id, image_id=new_image.id))
+        return {"images": results}, 200 if stored else 400
+
+
+@api.route(schemas["presigned_upload"])
+class PresignedUpload(Resource):
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.response(400, description="The image type or size is not allowed")
+    @api.response(501, description="The storage doesn't support direct uploads")
+    @api.response(200, description="Presigned upload to perform directly on the storage", model=Marshaller.presigned_upload)
+    @api.doc(security=security_grants)
+    @api.expect(Parsers.presigned_upload, validate=True)
+    @require_oauth("write")
+    def post(self):
+        data = Parsers.presigned_upload.parse_args()
+        if data["size"] < 1 or not check_size_type(data["content_type"], data["size"]):
+            return {"success": False}, 400
+        new_image = Image(title=data["title"], user_id=current_token.user.id, guid=uuid.uuid4().hex, status=RESERVED)
+        try:
+            post = storage.presign(new_image.guid, data["content_type"], data["size"], config["presigned_expiry"])
+        except StorageError:
+            return {"message": "Error preparing the upload on the storage"}, 400
+        if post is None:
+            return {"message": "The storage doesn't support direct uploads"}, 501
+        try:
+            db.session.add(new_image)
+            db.session.commit()
+        except SQLAlchemyError:
+            return {"success": False}, 400
+        response = dict()
+        response["id"] = new_image.id
+        response["guid"] = new_image.guid
+        response["url"] = post["url"]
+        response["fields"] = post["fields"]
+        response["expires_in"] = config["presigned_expiry"]
+        add_self(response, schemas["image"].format(user_id=new_image.user_id, image_id=new_image.id))
+        add_link(response, "complete", schemas["complete_upload"].format(image_id=new_image.id))
+        return response
+
+
+@api.route(schemas["complete_upload"].format(image_id="<image_id>"))
+class CompleteUpload(Resource):
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.response(404, description="Selected pending upload doesn't exist or has expired")
+    @api.response(400, description="The image wasn't uploaded or is not valid")
+    @api.response(200, description="Upload was successful")
+    @api.doc(security=security_grants)
+    @require_oauth("write")
+    def post(self, image_id):
+        image = Image.query.filter_by(id=image_id, user_id=current_token.user.id, status=RESERVED).first()
+        if not image or image.created_at < time.time() - config["presigned_expiry"]:
+            return {"message": "Selected upload doesn't exist"}, 404
+        try:
+            head = storage.head(image.guid)
+        except StorageError:
+            head = None
+        if head is None:
+            return {"message": "The image wasn't uploaded to the storage"}, 400
+        if not check_size_type(*head):
+            storage.delete(image.guid)
+            db.session.delete(image)
+            db.session.commit()
+            return {"success": False}, 400
+        image.status = ACTIVE
+        image.size = head[1]
+        image.width, image.height = stored_dimensions(image.guid)
+        db.session.commit()
+        invalidate_user(image.user_id)
+        derivatives.submit(image.guid)
+        response = {"success": True}
+        add_self(response, schemas["image"].format(user_id=image.user_id, image_id=image.id))
+        return response
+
 
 @api.route(schemas["image"].format(user_id="<user_id>", image_id="<image_id>"))
 class ImageQuery(Resource):
     @api.response(200, description="Information about the selected image", model=Marshaller.single_image)
+    @api.response(304, description="Selected image wasn't modified")
     @api.response(404, description="Selected image doesn't exist")
     @api.response(401, description="Unauthorized")
     @api.response(403, description="Forbidden")
     @api.doc(security=security_grants)
     @require_oauth("read")
+    @response_cache.cached(user_namespace)
     def get(self, user_id, image_id):
-        image = Image.query.filter_by(id=image_id, user_id=user_id).first()
+        image = Image.query.filter(Image.id == image_id, Image.user_id == user_id, Image.status != RESERVED).first()
         if not image:
             return {"message": "Selected image doesn't exist"}, 404
+        names = image.derivative_names
+        headers = validators([(image.id, image.guid, image.title, image.status, image.updated_at, image.width,
+                               image.height, image.size, names)], image.updated_at)
+        unchanged = not_modified(headers)
+        if unchanged is not None:
+            return unchanged
         response = dict()
         response["id"] = image_id
         response["guid"] = image.guid
         response["title"] = image.title
-        response["url"] = config["storage"].format(bucket_name=config["bucket_name"], guid=image.guid)
+        response["status"] = image.status
+        response["width"] = image.width
+        response["height"] = image.height
+        response["size"] = image.size
+        response["url"] = storage.url(image.key) or schemas["raw_image"].format(user_id=user_id, image_id=image_id)
         add_self(response, schemas["image"].format(user_id=user_id, image_id=image_id))
         user_link = dict()
         user_link["href"] = schemas["user"].format(id=user_id)
         response["_links"]["user"] = user_link
-        return response
+        add_link(response, "raw", schemas["raw_image"].format(user_id=user_id, image_id=image_id))
+        for name in names:
+            add_link(response, name, schemas["derivative_image"].format(user_id=user_id, image_id=image_id, name=name))
+        return response, 200, headers
 
     @api.response(200, description="Delete was successful")
     @api.response(404, description="Selected image doesn't exist")
@@ -153,12 +401,173 @@ class ImageQuery(Resource):
         image = Image.query.filter_by(id=image_id, user_id=user_id).first()
         if not image:
             return {"success": False}, 404
-        # Delete S3 Object
+        guid = image.guid
+        # Delete the SQL Object, and the stored Objects unless other images share them
         try:
-            client_s3.Object(config["bucket_name"], image.guid).delete()
-        except ClientError as e:
-            return {"aws_error": e.response["Error"]["Code"]}, 400
-        # Delete SQL Object
-        Image.query.filter_by(id=image_id).delete()
+            deleted = delete_image(image)
+        except StorageError as e:
+            db.session.rollback()
+            return {"aws_error": e.code}, 400
         db.session.commit()
+        invalidate_user(user_id)
+        spooler.discard(guid)
+        for key in deleted:
+            image_cache.discard(key)
         return {"success": True}
+
+
+@api.route(schemas["raw_image"].format(user_id="<user_id>", image_id="<image_id>"))
+class RawImage(Resource):
+    @api.response(200, description="Content of the selected image")
+    @api.response(206, description="Requested range of the content of the selected image")
+    @api.response(304, description="Selected image wasn't modified")
+    @api.response(404, description="Selected image doesn't exist")
+    @api.response(416, description="Requested range is not satisfiable")
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.doc(security=security_grants)
+    @require_oauth("read")
+    def get(self, user_id, image_id):
+        image = Image.query.filter_by(id=image_id, user_id=user_id, status=ACTIVE).first()
+        if not image:
+            return {"message": "Selected image doesn't exist"}, 404
+        return self.serve(image, image.key, image.guid)
+
+    @classmethod
+    def serve(cls, image, key, etag):
+        """ Serve the content stored under the key, the etag identifies it so it is checked before fetching anything """
+        last_modified = datetime.utcfromtimestamp(int(image.created_at or 0))
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = cls.send_local(storage.open(key) or cls.open_cached(key))
+        if response is None:
+            try:
+                stored = storage.get(key, request.headers.get("Range"))
+            except StorageError as e:
+                if e.code == "InvalidRange":
+                    return {"message": "Requested range is not satisfiable"}, 416
+                return {"aws_error": e.code}, 400
+            response = cls.stream(stored, key)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
+
+    @staticmethod
+    def open_cached(key):
+        path = image_cache.get(key)
+        try:
+            return open(path, "rb") if path else None
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return None
+
+    @staticmethod
+    def send_local(fp):
+        """ Serve a file of the local disk, through sendfile when the server supports it """
+        if fp is None:
+            return None
+        mimetype = sniff_mimetype(fp)
+        response = send_file(fp, mimetype=mimetype, conditional=False, add_etags=False)
+        return response.make_conditional(request, accept_ranges=True, complete_length=os.fstat(fp.fileno()).st_size)
+
+    @staticmethod
+    def stream(stored, key):
+        """ Stream the object from the storage without buffering it, caching it when requested whole """
+        if stored.content_range:
+            response = Response(stored, status=206, mimetype=stored.content_type, direct_passthrough=True)
+            response.headers["Content-Range"] = stored.content_range
+        else:
+            response = Response(cache_stream(stored, key), mimetype=stored.content_type, direct_passthrough=True)
+        response.content_length = stored.length
+        return response
+
+
+@api.route(schemas["derivative_image"].format(user_id="<user_id>", image_id="<image_id>", name="<name>"))
+class DerivativeImage(RawImage):
+    @api.response(200, description="Content of the derivative of the selected image")
+    @api.response(206, description="Requested range of the content of the derivative")
+    @api.response(304, description="Derivative wasn't modified")
+    @api.response(404, description="Selected image or derivative doesn't exist")
+    @api.response(416, description="Requested range is not satisfiable")
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.doc(security=security_grants)
+    @require_oauth("read")
+    def get(self, user_id, image_id, name):
+        image = Image.query.filter_by(id=image_id, user_id=user_id, status=ACTIVE).first()
+        if not image or name not in image.derivative_names:
+            return {"message": "Selected derivative doesn't exist"}, 404
+        return self.serve(image, derivative_key(image.key, name), "{}-{}".format(image.guid, name))
+
+
+@api.route(schemas["images"].format(user_id="<user_id>"))
+class BulkDelete(Resource):
+    @api.response(200, description="Delete was completed, possibly with errors", model=Marshaller.bulk_delete)
+    @api.response(400, description="Too many images were selected")
+    @api.response(401, description="Unauthorized")
+    @api.response(403, description="Forbidden")
+    @api.doc(security=security_grants)
+    @api.expect(Parsers.bulk_delete, validate=True)
+    @require_oauth("write")
+    def delete(self, user_id):
+        if user_id != str(current_token.user.id):
+            return {"success": False}, 401
+        ids = Parsers.bulk_delete.parse_args()["id"]
+        selected = Image.query.filter(Image.user_id == user_id)
+        if ids is not None:
+            if len(ids) > config["max_bulk_delete"]:
+                return {"message": "Up to {} images can be deleted at once".format(config["max_bulk_delete"])}, 400
+            selected = selected.filter(Image.id.in_(ids))
+        images = selected.with_entities(Image.id, Image.guid, Image.blob_digest, Image.derivatives).all()
+        if not images:
+            return {"deleted": 0, "errors": []}
+        # Delete stored Objects that no other image shares
+        ids_by_key = defaultdict(list)
+        for image in images:
+            ids_by_key[image.blob_digest or image.guid].append(image.id)
+        references = Counter(image.blob_digest for image in images if image.blob_digest)
+        orphans = [image.guid for image in images if not image.blob_digest]
+        orphans += [digest for digest, count in references.items() if Blob.release(digest, count)]
+        try:
+            errors = storage.delete_many(orphans)
+        except StorageError as e:
+            db.session.rollback()
+            return {"aws_error": e.code}, 400
+        failed = {error["Key"] for error in errors}
+        for digest in failed & references.keys():
+            Blob.restore(digest, references[digest])
+        names_by_key = Blob.derivatives_of(set(orphans) - failed)
+        names_by_key.update((image.guid, (image.derivatives or "").split())
+                            for image in images if not image.blob_digest and image.guid not in failed)
+        derived = [derivative_key(key, name) for key, names in names_by_key.items() for name in names]
+        # Delete SQL Objects, leaving the ones whose object couldn't be deleted and the ones uploaded meanwhile
+        deleted = selected.filter(Image.id <= max(image.id for image in images))
+        if failed:
+            deleted = deleted.filter(Image.guid.notin_(list(failed)),
+                                     or_(Image.blob_digest.is_(None), Image.blob_digest.notin_(list(failed))))
+        count = deleted.delete(synchronize_session=False)
+        Blob.remove_unreferenced(references.keys() - failed)
+        db.session.commit()
+        invalidate_user(user_id)
+        # The derivatives of the deleted contents are left behind if they can't be deleted
+        try:
+            storage.delete_many(derived)
+        except StorageError:
+            app.logger.exception("Error deleting the derivatives of the deleted images")
+        for key in (set(orphans) - failed) | set(derived):
+            image_cache.discard(key)
+        return {"deleted": count, "errors": [{"ids": ids_by_key.get(error["Key"]), **error} for error in errors]}
+
+
+@api.route(schemas["stats"])
+class Stats(Resource):
+    @api.response(200, description="Statistics of the caches of the serving process")
+    @api.response(401, description="Unauthorized")
+    @api.doc(security=security_grants)
+    @require_oauth("read")
+    def get(self):
+        return {"token_cache": token_cache.stats(), "response_cache": response_cache.stats(),
+                "image_cache": image_cache.stats()}
@@ -1,9 +1,11 @@
+from functools import lru_cache
 from pathlib import Path
 
 from flask_restx import Api
 from .auth.routes import api as auth
 from .api.routes import api as users
 from webapp import schemas
+from .hashing import HasherBusy
 
 authorizations = {
     "oauth2_code": {
@@ -37,8 +39,14 @@ authorizations = {
     }
 }
 path = Path(__file__).parent
-with open(path / "swagger_description.md", "r") as fp:
-    description = fp.read()
+
+
+# Read when the Swagger spec is first rendered, which flask-restx then keeps for the worker
+@lru_cache(maxsize=None)
+def description():
+    with open(path / "swagger_description.md", "r") as fp:
+        return fp.read()
+
 
 api = Api(authorizations=authorizations,
           doc="/swagger",
@@ -48,3 +56,9 @@ api.add_namespace(users, "/api")
 api.add_namespace(auth, "/auth")
 
 
+@api.errorhandler(HasherBusy)
+def hasher_busy(error):
+    """ Shed password operations when the hashing queue is full """
+    return {"message": "Too many password operations in progress, retry later"}, 503, {"Retry-After": "1"}
+
+
@@ -5,8 +5,14 @@ from authlib.integrations.sqla_oauth2 import (
     OAuth2AuthorizationCodeMixin,
     OAuth2TokenMixin,
 )
+from sqlalchemy import or_
 from ..modules import db
 
+# Lifetime of an authorization code, as checked by OAuth2AuthorizationCodeMixin.is_expired
+CODE_LIFETIME = 300
+# Refresh tokens stay usable for this many times the lifetime of their access token
+REFRESH_LIFETIME_FACTOR = 2
+
 
 class OAuth2Client(db.Model, OAuth2ClientMixin):
     __tablename__ = "oauth2_client"
@@ -25,11 +31,19 @@ class OAuth2AuthorizationCode(db.Model, OAuth2AuthorizationCodeMixin):
         db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"))
     user = db.relationship("User")
 
+    @classmethod
+    def expired(cls, now):
+        """ Condition matching the codes that is_expired would reject """
+        return cls.auth_time + CODE_LIFETIME < now
+
 
 class OAuth2Token(db.Model, OAuth2TokenMixin):
     __tablename__ = "oauth2_token"
 
     id = db.Column(db.Integer, primary_key=True)
+    # Signed access tokens are longer than the 255 characters of the mixin, this length is the longest a unique
+    # index of MySQL allows with utf8mb4
+    access_token = db.Column(db.String(768), unique=True, nullable=False)
     user_id = db.Column(
         db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"))
     user = db.relationship("User")
@@ -37,5 +51,10 @@ class OAuth2Token(db.Model, OAuth2TokenMixin):
     def is_refresh_token_active(self):
         if self.revoked:
             return False
-        expires_at = self.issued_at + self.expires_in * 2
+        expires_at = self.issued_at + self.expires_in * REFRESH_LIFETIME_FACTOR
         return expires_at >= time.time()
+
+    @classmethod
+    def refresh_token_inactive(cls, now):
+        """ Condition matching the tokens that is_refresh_token_active would reject """
+        return or_(cls.revoked.is_(True), cls.issued_at + cls.expires_in * REFRESH_LIFETIME_FACTOR < now)
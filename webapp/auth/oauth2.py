@@ -1,3 +1,7 @@
+import hashlib
+import time
+from os import environ
+
 from authlib.integrations.flask_oauth2 import AuthorizationServer, ResourceProtector
 from authlib.integrations.sqla_oauth2 import (
     create_query_client_func,
@@ -6,9 +10,84 @@ from authlib.integrations.sqla_oauth2 import (
     create_bearer_token_validator,
 )
 from authlib.oauth2.rfc6749 import grants
+from sqlalchemy.orm import joinedload
 from werkzeug.security import gen_salt
 from webapp.auth.model import db, OAuth2AuthorizationCode, OAuth2Client, OAuth2Token
 from webapp.api.model import User
+from webapp.cache import TTLCache, Denylist
+from webapp.modules import config
+
+# Validated bearer tokens, keyed by the hash of the access token
+token_cache = TTLCache(config["token_cache_size"], config["token_cache_ttl"])
+# Revoked signed tokens, each kept until the token would have expired anyway
+token_denylist = Denylist()
+
+
+def token_cache_key(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+def forget_token(token):
+    """ Drop a revoked token from the cache, and deny it if it can be verified without the database """
+    key = token_cache_key(token.access_token)
+    token_cache.delete(key)
+    ttl = token.get_expires_at() - time.time()
+    if is_signed(token.access_token) and ttl > 0:
+        token_denylist.add(key, ttl)
+
+
+def is_signed(access_token):
+    return access_token.count(".") == 2
+
+
+class TokenUser:
+    """ Owner of a signed token, known only by its id """
+
+    def __init__(self, id):
+        self.id = id
+
+    def get_user_id(self):
+        return self.id
+
+
+class SignedToken:
+    """ Access token verified from its signature, without a database row """
+
+    def __init__(self, access_token, claims):
+        self.access_token = access_token
+        self.client_id = claims["cid"]
+        self.scope = claims["scope"]
+        self.expires_at = claims["exp"]
+        self.user = TokenUser(int(claims["sub"])) if "sub" in claims else None
+
+    def get_client_id(self):
+        return self.client_id
+
+    def get_scope(self):
+        return self.scope
+
+    def get_expires_at(self):
+        return self.expires_at
+
+
+class SignedBearerToken:
+    """ Token generator replacing the random access token of the bearer one with a signed JWT """
+
+    def __init__(self, bearer, key):
+        self.bearer = bearer
+        self.key = key
+
+    def __call__(self, client, grant_type, user=None, scope=None, expires_in=None, include_refresh_token=True):
+        # authlib.jose loads cryptography, only workers issuing signed tokens pay for it
+        from authlib.jose import jwt
+        token = self.bearer(client, grant_type, user, scope, expires_in, include_refresh_token)
+        now = int(time.time())
+        claims = {"jti": gen_salt(16), "cid": client.client_id, "scope": scope or "", "iat": now,
+                  "exp": now + token["expires_in"]}
+        if user is not None:
+            claims["sub"] = str(user.get_user_id())
+        token["access_token"] = jwt.encode({"alg": "HS256"}, claims, self.key).decode()
+        return token
 
 
 class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
@@ -62,6 +141,57 @@ class RefreshTokenGrant(grants.RefreshTokenGrant):
         credential.revoked = True
         db.session.add(credential)
         db.session.commit()
+        forget_token(credential)
+
+
+class RevocationEndpoint(create_revocation_endpoint(db.session, OAuth2Token)):
+    def revoke_token(self, token):
+        super().revoke_token(token)
+        forget_token(token)
+
+
+class BearerTokenValidator(create_bearer_token_validator(db.session, OAuth2Token)):
+    def authenticate_token(self, token_string):
+        key = token_cache_key(token_string)
+        token = token_cache.get(key)
+        if token is None:
+            token = OAuth2Token.query.options(joinedload(OAuth2Token.user)) \
+                .filter_by(access_token=token_string).first()
+            if token is None:
+                return None
+            # Keep a detached copy in the cache, the session one is expired on commit
+            if token.user is not None:
+                db.session.expunge(token.user)
+            db.session.expunge(token)
+            ttl = min(token_cache.ttl, token.get_expires_at() - time.time())
+            if ttl > 0:
+                token_cache.set(key, token, ttl)
+        return db.session.merge(token, load=False)
+
+
+class SignedBearerTokenValidator(BearerTokenValidator):
+    """ Verifies signed tokens from their signature and the denylist, other tokens from the database """
+
+    def __init__(self, key, realm=None):
+        super().__init__(realm)
+        self.key = key
+
+    def authenticate_token(self, token_string):
+        if not is_signed(token_string):
+            return super().authenticate_token(token_string)
+        from authlib.jose import jwt
+        from authlib.jose.errors import JoseError
+        try:
+            claims = jwt.decode(token_string, self.key)
+            claims.validate()
+        except JoseError:
+            return None
+        return SignedToken(token_string, claims)
+
+    def token_revoked(self, token):
+        if isinstance(token, SignedToken):
+            return token_cache_key(token.access_token) in token_denylist
+        return super().token_revoked(token)
 
 
 query_client = create_query_client_func(db.session, OAuth2Client)
@@ -84,9 +214,12 @@ def config_oauth(app):
     authorization.register_grant(RefreshTokenGrant)
 
     # support revocation
-    revocation_cls = create_revocation_endpoint(db.session, OAuth2Token)
-    authorization.register_endpoint(revocation_cls)
-
-    # protect resource
-    bearer_cls = create_bearer_token_validator(db.session, OAuth2Token)
-    require_oauth.register_token_validator(bearer_cls())
+    authorization.register_endpoint(RevocationEndpoint)
+
+    # protect resource, optionally issuing signed access tokens that don't need a database lookup
+    if config["token_format"] == "jwt":
+        key = environ.get("JWT_SECRET", app.config["SECRET_KEY"])
+        authorization.generate_token = SignedBearerToken(authorization.generate_token, key)
+        require_oauth.register_token_validator(SignedBearerTokenValidator(key))
+    else:
+        require_oauth.register_token_validator(BearerTokenValidator())
@@ -0,0 +1,69 @@
+import random
+import threading
+import time
+
+from webapp.auth.model import db, OAuth2AuthorizationCode, OAuth2Token
+from webapp.modules import app, config
+from webapp.storage import expire_pending_uploads
+
+
+def delete_in_chunks(model, condition, chunk_size):
+    """ Delete the matching rows a chunk per transaction, so that the write lock is held briefly """
+    removed = 0
+    while True:
+        ids = [id for id, in db.session.query(model.id).filter(condition).limit(chunk_size)]
+        if not ids:
+            return removed
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += len(ids)
+
+
+def sweep_expired(now=None, chunk_size=None):
+    """ Remove the tokens that can't be used or refreshed anymore and the expired authorization codes """
+    now = now or time.time()
+    chunk_size = chunk_size or config["sweep_chunk_size"]
+    return {
+        "tokens": delete_in_chunks(OAuth2Token, OAuth2Token.refresh_token_inactive(now), chunk_size),
+        "codes": delete_in_chunks(OAuth2AuthorizationCode, OAuth2AuthorizationCode.expired(now), chunk_size),
+    }
+
+
+class Sweeper:
+    """ Runs sweep_expired and expire_pending_uploads periodically in a background thread of the serving process """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.interval > 0:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # Spread the sweeps of the worker processes over the interval
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            self.sweep()
+            time.sleep(self.interval)
+
+    @staticmethod
+    def sweep():
+        try:
+            with app.app_context():
+                removed = sweep_expired()
+            app.logger.info("Swept %(tokens)d expired tokens and %(codes)d expired codes", removed)
+        except Exception:
+            app.logger.exception("Error sweeping expired tokens")
+        try:
+            with app.app_context():
+                expired = expire_pending_uploads()
+            app.logger.info("Removed %d expired uploads", expired)
+        except Exception:
+            app.logger.exception("Error removing expired uploads")
+
+
+sweeper = Sweeper(config["sweep_interval"])
@@ -0,0 +1,320 @@
+import functools
+import hashlib
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import request
+
+
+class TTLCache:
+    """ Thread-safe LRU cache whose entries expire after a time to live """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.memory = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (expires_at, value)
+            self.memory += sys.getsizeof(value)
+            while len(self._items) > self.maxsize:
+                self._remove(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.memory = 0
+
+    def _remove(self, key):
+        self.memory -= sys.getsizeof(self._items.pop(key)[1])
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {"size": len(self._items), "memory": self.memory, "hits": self.hits, "misses": self.misses}
+
+
+class Denylist:
+    """ Thread-safe set of keys each kept until its time to live is over. Unlike a cache it is never evicted before,
+    as a key dropped early would be allowed again: its size is bounded by the keys added over the longest TTL """
+
+    def __init__(self):
+        self._expiry = dict()
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if now + ttl > self._expiry.get(key, 0):
+                self._expiry[key] = now + ttl
+                heapq.heappush(self._heap, (now + ttl, key))
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._expiry.get(key, 0) >= time.monotonic()
+
+    def _purge(self, now):
+        while self._heap and self._heap[0][0] < now:
+            expires_at, key = heapq.heappop(self._heap)
+            # Keys added again later have a later expiry
+            if self._expiry.get(key) == expires_at:
+                del self._expiry[key]
+
+    def __len__(self):
+        return len(self._expiry)
+
+
+class FileSystemCache:
+    """ Cache shared by the processes of a host, storing each entry in a file of the directory """
+
+    def __init__(self, directory, maxsize, ttl):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), "rb") as fp:
+                expires_at = float(fp.readline())
+                value = fp.read()
+        except (OSError, ValueError):
+            self.misses += 1
+            return default
+        if expires_at < time.time():
+            self.delete(key)
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value.decode()
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        path = self._path(key)
+        temp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(temp, "wb") as fp:
+            fp.write("{}\n".format(expires_at).encode())
+            fp.write(value.encode())
+        os.replace(temp, path)
+        self._writes += 1
+        if self._writes % max(self.maxsize // 10, 1) == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """ Remove the oldest entries exceeding the maximum size """
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+        for _, path in sorted(entries)[:max(len(entries) - self.maxsize, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        sizes = [entry.stat().st_size for entry in os.scandir(self.directory)]
+        return {"size": len(sizes), "memory": sum(sizes), "hits": self.hits, "misses": self.misses}
+
+
+class ResponseCache:
+    """ Cache of the serialized responses of the read endpoints, invalidated by namespace """
+
+    # Namespace versions outlive the responses, a lost version just orphans the entries of its namespace
+    VERSION_TTL = 24 * 60 * 60
+
+    def __init__(self, backend, not_modified):
+        self.backend = backend
+        self.not_modified = not_modified
+        self.hits = 0
+        self.misses = 0
+
+    def _version(self, namespace):
+        version = self.backend.get("version:" + namespace)
+        if version is None:
+            version = self.invalidate(namespace)
+        return version
+
+    def invalidate(self, namespace):
+        version = uuid.uuid4().hex
+        if self.backend is not None:
+            self.backend.set("version:" + namespace, version, self.VERSION_TTL)
+        return version
+
+    def key(self, namespace, path):
+        return "{}:{}:{}".format(namespace, self._version(namespace), path)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, data, headers):
+        self.backend.set(key, json.dumps([data, headers]))
+
+    def cached(self, namespace):
+        """ Serve a GET resource method from the cache, namespace is formatted with the view arguments """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None:
+                    return f(*args, **kwargs)
+                # Taken before building the response, so that an invalidation meanwhile discards it
+                key = self.key(namespace.format(**kwargs), request.full_path)
+                hit = self.get(key)
+                if hit is not None:
+                    unchanged = self.not_modified(hit[1])
+                    if unchanged is not None:
+                        return unchanged
+                    return hit[0], 200, hit[1]
+                result = f(*args, **kwargs)
+                if isinstance(result, tuple) and len(result) == 3 and result[1] == 200:
+                    self.set(key, result[0], result[2])
+                return result
+            return wrapper
+        return decorator
+
+    def stats(self):
+        requests = self.hits + self.misses
+        stats = self.backend.stats() if self.backend is not None else {"size": 0, "memory": 0}
+        return {"size": stats["size"], "memory": stats["memory"], "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0}
+
+
+class BlobCache:
+    """ Least recently used files on local disk, bounded by their total size, for immutable objects """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """ Path of the cached file, marked as recently used, or None """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def temp_path(self, key):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        return "{}.{}.tmp".format(self.path(key), uuid.uuid4().hex)
+
+    def commit(self, temp, key):
+        """ Publish a completely written temporary file, evicting the least recently used files over the bound """
+        size = os.path.getsize(temp)
+        os.replace(temp, self.path(key))
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._size = self.prune()
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if not entry.name.endswith(".tmp"):
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def prune(self):
+        """ Remove the least recently used files exceeding the size bound, returns the size left """
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        return size
+
+    def stats(self):
+        entries = list(self._entries())
+        return {"size": len(entries), "memory": sum(entry[1] for entry in entries),
+                "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import random
+import struct
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam
+from webapp.api.model import User, Image, Blob, ACTIVE
+from webapp.auth.model import OAuth2Token
+from webapp.modules import db
+from webapp.storage import storage
+
+DAY = 24 * 3600
+# Lifetimes granted by the clients seeded by bootstrap: the implicit grant of "dummy" issues short lived tokens
+# without refresh token, the password and authorization code grants of "documentation" the default ones
+TOKEN_GRANTS = [("documentation", 864000, 0.8), ("dummy", 3600, 0.2)]
+# Tokens are mostly recent, as clients log in again once theirs expire
+TOKEN_MEAN_AGE = 3 * DAY
+TOKEN_MAX_AGE = 30 * DAY
+REVOKED_RATIO = 0.05
+# Accounts and images are spread over this period
+HISTORY = 365 * DAY
+
+
+def content(number, prefix):
+    """ 1x1 GIF made distinct by a comment naming the dataset and its number """
+    comment = "{}-{}".format(prefix, number).encode()
+    return (b"GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00"
+            b"!\xfe" + struct.pack("B", len(comment)) + comment + b"\x00"
+            b",\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;")
+
+
+def batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert(table, rows, batch_size):
+    """ Insert the rows with one executemany and one transaction per batch """
+    for batch in batches(rows, batch_size):
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+
+
+def token_rows(rng, user_ids, count, now):
+    grants = [(client_id, expires_in) for client_id, expires_in, _ in TOKEN_GRANTS]
+    weights = [weight for _, _, weight in TOKEN_GRANTS]
+    for _ in range(count):
+        client_id, expires_in = rng.choices(grants, weights)[0]
+        age = min(rng.expovariate(1 / TOKEN_MEAN_AGE), TOKEN_MAX_AGE)
+        yield {"client_id": client_id, "user_id": rng.choice(user_ids), "token_type": "Bearer",
+               "access_token": uuid.uuid4().hex,
+               "refresh_token": uuid.uuid4().hex if client_id == "documentation" else None,
+               "scope": "read write", "revoked": rng.random() < REVOKED_RATIO,
+               "issued_at": int(now - age), "expires_in": expires_in}
+
+
+def generate(users, images, tokens, contents=1, password="password", prefix=None, batch_size=10000,
+             populate=False, workers=8, seed=None):
+    """ Bulk insert users sharing one password hash, images spread over them and sharing the given number of
+    contents, and OAuth tokens of various ages. The contents are written to the storage in parallel when populating it.
+    Returns the prefix of the usernames, which are numbered from 0 """
+    rng = random.Random(seed)
+    prefix = prefix or uuid.uuid4().hex[:8]
+    now = int(time.time())
+    password = User.generate_hash(password)
+
+    def created_at():
+        return now - rng.randrange(HISTORY)
+
+    insert(User.__table__, ({"username": "{}-{}".format(prefix, number), "password": password,
+                             "created_at": created_at(), "updated_at": now} for number in range(users)), batch_size)
+    user_ids = [id for id, in db.session.query(User.id).filter(User.username.like(prefix + "-%"))]
+
+    sizes = dict()
+    for number in range(min(contents, images)):
+        data = content(number, prefix)
+        sizes[hashlib.sha256(data).hexdigest()] = len(data)
+    digests = list(sizes)
+    if populate:
+        def put(number):
+            storage.put(io.BytesIO(content(number, prefix)), digests[number], "image/gif")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(put, range(len(digests))))
+    insert(Blob.__table__, ({"digest": digest, "refs": 0, "created_at": now} for digest in digests), batch_size)
+
+    refs = Counter()
+
+    def image_rows():
+        for number in range(images):
+            digest = rng.choice(digests)
+            refs[digest] += 1
+            yield {"guid": uuid.uuid4().hex, "title": "image {}".format(number), "user_id": rng.choice(user_ids),
+                   "status": ACTIVE, "blob_digest": digest, "width": 1, "height": 1, "size": sizes[digest],
+                   "created_at": created_at(), "updated_at": now}
+
+    insert(Image.__table__, image_rows(), batch_size)
+    blobs = Blob.__table__
+    for batch in batches(refs.items(), batch_size):
+        db.session.execute(blobs.update().where(blobs.c.digest == bindparam("key"))
+                           .values(refs=blobs.c.refs + bindparam("count")),
+                           [{"key": digest, "count": count} for digest, count in batch])
+        db.session.commit()
+    insert(OAuth2Token.__table__, token_rows(rng, user_ids, tokens, now), batch_size)
+    return prefix
@@ -0,0 +1,120 @@
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from webapp.api.model import Image, Blob
+from webapp.modules import app, db, config
+from webapp.storage import storage, StorageError, derivative_key
+from webapp.util import invalidate_user
+
+# Formats that browsers display, other ones are rendered as PNG
+WEB_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+
+
+def encode(picture, image_format, quality):
+    if image_format == "JPEG" and picture.mode not in ("RGB", "L"):
+        picture = picture.convert("RGB")
+    elif image_format == "WEBP" and picture.mode not in ("RGB", "RGBA"):
+        picture = picture.convert("RGBA")
+    content = io.BytesIO()
+    picture.save(content, image_format, quality=quality)
+    return content.getvalue(), "image/" + image_format.lower()
+
+
+def render(data, sizes, modern_format, quality):
+    """ Derivatives of the image, run in the worker processes: each size fits in a square of that many pixels and
+    keeps the format of the original, the modern format variant keeps the size of the original """
+    from PIL import Image as Picture
+    original = Picture.open(io.BytesIO(data))
+    original.load()
+    image_format = original.format if original.format in WEB_FORMATS else "PNG"
+    rendered = dict()
+    for name, size in sizes.items():
+        picture = original.copy()
+        picture.thumbnail((size, size))
+        rendered[name] = encode(picture, image_format, quality)
+    rendered[modern_format.lower()] = encode(original, modern_format.upper(), quality)
+    return rendered
+
+
+class Derivatives:
+    """ Renders the derivatives of the new contents in a process pool, off the request path. The threads waiting for
+    the pool read the content back from the storage, so queued contents aren't held in memory, and write the
+    derivatives next to it before listing them on the blob of the content, or on the image stored under its guid """
+
+    def __init__(self, settings):
+        self.sizes = settings["derivative_sizes"]
+        self.format = settings["derivative_format"]
+        self.quality = settings["derivative_quality"]
+        self.workers = settings["derivative_workers"]
+        self._threads = ThreadPoolExecutor(max_workers=self.workers)
+        self._processes = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """ Forget the pool of the parent process, the child creates its own on first use """
+        self._processes = None
+        self._threads = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.workers)
+            return self._processes
+
+    def submit(self, key):
+        """ Queue the rendering of the derivatives of the content stored under the key """
+        future = self._threads.submit(self._generate, key)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _generate(self, key):
+        try:
+            stored = storage.get(key)
+            try:
+                data = b"".join(stored)
+            finally:
+                stored.close()
+            rendered = self._pool().submit(render, data, self.sizes, self.format, self.quality).result()
+        except Exception:
+            app.logger.exception("Error rendering the derivatives of %s", key)
+            return
+        with app.app_context():
+            try:
+                for name, (content, content_type) in rendered.items():
+                    storage.put(io.BytesIO(content), derivative_key(key, name), content_type)
+            except StorageError:
+                app.logger.exception("Error storing the derivatives of %s", key)
+                storage.delete_many([derivative_key(key, name) for name in rendered])
+                return
+            # Contents are keyed by their digest, or by the guid of their image when uploaded directly
+            names = {"derivatives": " ".join(rendered)}
+            updated = Blob.query.filter_by(digest=key).update(names) or \
+                Image.query.filter_by(guid=key, blob_digest=None).update(names)
+            db.session.commit()
+            if not updated:
+                # The content was deleted meanwhile
+                storage.delete_many([derivative_key(key, name) for name in rendered])
+                return
+            users = db.session.query(Image.user_id).filter((Image.blob_digest == key) | (Image.guid == key))
+            for (user_id,) in users.distinct():
+                invalidate_user(user_id)
+
+    def join(self):
+        """ Wait until the queued derivatives are stored """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+
+derivatives = Derivatives(config)
@@ -0,0 +1,52 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import pbkdf2_sha256 as sha256
+from webapp.modules import config
+
+
+class HasherBusy(Exception):
+    """ Raised when the password hashing queue is full """
+
+
+def _hash(password, rounds):
+    return sha256.using(rounds=rounds).hash(password)
+
+
+def _verify(password, hashed):
+    return sha256.verify(password, hashed)
+
+
+class PasswordHasher:
+    """ Runs pbkdf2_sha256 in a bounded process pool, keeping it off the request threads and the GIL """
+
+    def __init__(self, workers, max_queue, rounds):
+        self.workers = workers
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            # The pool is created by the process using it, after any fork of the server
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._submit(_hash, password, self.rounds)
+
+    def verify(self, password, hashed):
+        return self._submit(_verify, password, hashed)
+
+    def needs_update(self, hashed):
+        return sha256.from_string(hashed).rounds != self.rounds
+
+
+hasher = PasswordHasher(config["hash_workers"], config["hash_queue"], config["hash_rounds"])
@@ -0,0 +1,96 @@
+import time
+
+from sqlalchemy import inspect
+from webapp.modules import db
+
+# Version of the schema of the database, dropped and recreated together with the models
+schema_version = db.Table("schema_version", db.Column("version", db.Integer, primary_key=True))
+
+
+def create_tables(connection):
+    db.Model.metadata.create_all(connection)
+
+
+def add_columns(table, columns):
+    """ Migration adding the columns, given as name and DDL, that the table doesn't have yet """
+    def migration(connection):
+        existing = {column["name"] for column in inspect(connection).get_columns(table)}
+        for name, ddl in columns:
+            if name not in existing:
+                connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, name, ddl))
+    return migration
+
+
+def alter_columns(table, columns):
+    """ Migration changing the type of the columns, given as name and type. SQLite doesn't enforce the lengths of the
+    types, nor can alter columns, so the migration is a no-op there """
+    def migration(connection):
+        dialect = connection.dialect.name
+        for name, ddl in columns:
+            if dialect == "postgresql":
+                connection.execute("ALTER TABLE {} ALTER COLUMN {} TYPE {}".format(table, name, ddl))
+            elif dialect == "mysql":
+                not_null = "" if db.Model.metadata.tables[table].c[name].nullable else " NOT NULL"
+                connection.execute("ALTER TABLE {} MODIFY {} {}{}".format(table, name, ddl, not_null))
+    return migration
+
+
+def create_indexes(table):
+    """ Migration creating the indexes of the table that don't exist yet """
+    def migration(connection):
+        existing = {index["name"] for index in inspect(connection).get_indexes(table)}
+        for index in db.Model.metadata.tables[table].indexes:
+            if index.name not in existing:
+                index.create(connection)
+    return migration
+
+
+def drop_indexes(table, names):
+    def migration(connection):
+        existing = {index["name"] for index in inspect(connection).get_indexes(table)}
+        for name in names:
+            if name in existing:
+                connection.execute("DROP INDEX {}".format(name))
+    return migration
+
+
+# Each migration brings a database from the previous version to its own, they are written so that they
+# are no-ops on a database created from the current models
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_columns("images", [
+        ("status", "VARCHAR(16) NOT NULL DEFAULT 'active'"),
+        ("created_at", "INTEGER NOT NULL DEFAULT {}".format(int(time.time()))),
+        ("updated_at", "INTEGER NOT NULL DEFAULT {}".format(int(time.time()))),
+    ])),
+    (3, add_columns("users", [
+        ("created_at", "INTEGER NOT NULL DEFAULT {}".format(int(time.time()))),
+        ("updated_at", "INTEGER NOT NULL DEFAULT {}".format(int(time.time()))),
+    ])),
+    (4, drop_indexes("images", ["ix_images_status"])),
+    (5, create_indexes("images")),
+    # Blobs of the deduplicated content
+    (6, create_tables),
+    (7, add_columns("images", [("blob_digest", "VARCHAR(64) REFERENCES blobs (digest)")])),
+    # Derivatives and dimensions of the images
+    (8, add_columns("blobs", [("derivatives", "VARCHAR(120)")])),
+    (9, add_columns("images", [("width", "INTEGER"), ("height", "INTEGER"), ("size", "INTEGER")])),
+    # Signed access tokens
+    (10, alter_columns("oauth2_token", [("access_token", "VARCHAR(768)")])),
+    # Derivatives of the contents stored under the guid of the image
+    (11, add_columns("images", [("derivatives", "VARCHAR(120)")])),
+]
+
+
+def migrate(bind=None):
+    """ Apply the pending migrations, returns the versions applied """
+    applied = []
+    with (bind or db.engine).begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        current = connection.execute(db.select([db.func.max(schema_version.c.version)])).scalar() or 0
+        for version, migration in MIGRATIONS:
+            if version > current:
+                migration(connection)
+                connection.execute(schema_version.insert().values(version=version))
+                applied.append(version)
+    return applied
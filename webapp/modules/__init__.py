@@ -1,8 +1,11 @@
 from os import environ
 
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+
 from flask import Flask, redirect
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 from json import load
 from pathlib import Path
 
@@ -18,10 +21,34 @@ with open(path / "../schemas.json", "r") as fp:
 with open(path / "../config.json", "r") as fp:
     config = load(fp)
 
+
+def engine_options(uri):
+    """ Connection pool of each worker process, SQLite connections are kept open to reuse their page cache """
+    url = make_url(uri)
+    if url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:"):
+        return {}
+    options = {
+        "pool_size": config["db_pool_size"],
+        "max_overflow": config["db_max_overflow"],
+        "pool_timeout": config["db_pool_timeout"],
+        "pool_recycle": config["db_pool_recycle"],
+    }
+    if url.drivername.startswith("sqlite"):
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False, "timeout": config["sqlite_busy_timeout_ms"] / 1000}
+    else:
+        options["pool_pre_ping"] = True
+    return options
+
+
 app = Flask(__name__, template_folder="templates")
 app.config["SECRET_KEY"] = "3205fc85cd004116bfe218f14192e49a"
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///app.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = environ.get("DATABASE_URL", config["database_uri"])
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Reject request bodies that cannot hold acceptable images before reading them
+max_upload_length = (config["max_size_kb"] + config["max_form_overhead_kb"]) * 1000
+app.config["MAX_CONTENT_LENGTH"] = max_upload_length * config["max_batch_size"]
 app.config["SWAGGER_UI_OAUTH_CLIENT_ID"] = "documentation"
 domain = app.config.get("SERVER_NAME")
 
@@ -30,7 +57,8 @@ port = environ.get("PORT", config["default_port"])
 redirect_uri = environ.get("REDIRECT_URI", config["redirect_uri"])
 client_uri = environ.get("CLIENT_URI", config["client_uri"])
 
-client_s3 = boto3.resource("s3")
+# Bounded pool writing the images of batch uploads in parallel
+upload_pool = ThreadPoolExecutor(max_workers=config["upload_concurrency"])
 
 
 @app.route("/")
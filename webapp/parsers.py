@@ -12,6 +12,24 @@ class Parsers:
     image_upload.add_argument("title",
                               required=True)
 
+    batch_upload = reqparse.RequestParser()
+    batch_upload.add_argument("image",
+                              type=datastructures.FileStorage,
+                              required=True,
+                              location="files",
+                              action="append",
+                              help="Image files")
+    batch_upload.add_argument("title",
+                              required=True,
+                              location="form",
+                              action="append",
+                              help="Titles of the images, in the same order")
+
+    presigned_upload = reqparse.RequestParser()
+    presigned_upload.add_argument("title", required=True, location="form")
+    presigned_upload.add_argument("content_type", required=True, location="form", help="MIME type of the image")
+    presigned_upload.add_argument("size", type=int, required=True, location="form", help="Size of the image in bytes")
+
     login = reqparse.RequestParser()
     login.add_argument("username", required=True, location="form")
     login.add_argument("password", required=True, location="form")
@@ -29,5 +47,14 @@ class Parsers:
     register.add_argument("username", required=True, location="form")
     register.add_argument("password", required=True, location="form")
 
+    bulk_delete = reqparse.RequestParser()
+    bulk_delete.add_argument("id", type=int, location="args", action="append",
+                             help="Images to delete, all the images of the user when omitted")
+
+    page = reqparse.RequestParser()
+    page.add_argument("limit", type=int, location="args", help="Maximum number of items in the page")
+    page.add_argument("after", location="args", help="Return the items following this cursor")
+    page.add_argument("before", location="args", help="Return the items preceding this cursor")
+
     authorize = reqparse.RequestParser()
     authorize.add_argument("user_id", required=True)
@@ -0,0 +1,54 @@
+import os
+import threading
+from functools import lru_cache
+
+from webapp.modules import config
+
+
+class S3ClientFactory:
+    """ S3 client shared by the threads of a worker process, created on first use and again after a fork """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._client = None
+        self._lock = threading.Lock()
+        # A client created before gunicorn --preload forks would share its connections with the other workers
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.create()
+                client = self._client
+        return client
+
+    def create(self):
+        """ boto3 takes longer to import and set up than the rest of the app, so it is loaded here """
+        import boto3
+        from botocore.config import Config
+        session = boto3.session.Session()
+        return session.client("s3", endpoint_url=self.settings["s3_endpoint_url"], config=Config(
+            max_pool_connections=self.settings["s3_max_pool_connections"],
+            connect_timeout=self.settings["s3_connect_timeout"],
+            read_timeout=self.settings["s3_read_timeout"],
+            retries={"mode": self.settings["s3_retry_mode"], "max_attempts": self.settings["s3_max_attempts"]},
+        ))
+
+
+@lru_cache(maxsize=None)
+def transfer_config():
+    """ Uploads are streamed in chunks, switching to multipart uploads above the threshold """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=config["multipart_threshold_kb"] * 1024,
+                          multipart_chunksize=config["multipart_chunk_kb"] * 1024,
+                          max_concurrency=config["upload_concurrency"])
+
+
+s3_client = S3ClientFactory(config)
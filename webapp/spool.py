@@ -0,0 +1,168 @@
+import fcntl
+import os
+import queue
+import shutil
+import threading
+import time
+
+from webapp.api.model import Image, ACTIVE, FAILED
+from webapp.derivatives import derivatives
+from webapp.modules import app, db, config
+from webapp.storage import StorageError, store_content, forget_contents
+from webapp.util import sniff_mimetype, invalidate_user, content_digest
+
+CHUNK_SIZE = 64 * 1024
+# Temporary files are locked while they are written, an unlocked one this old was left by a stopped process
+STALE_TMP_AGE = 60
+
+
+def claim(path):
+    """ The file opened and locked exclusively, None if another thread or process holds it or it was removed or
+    replaced meanwhile. The lock is released when the file is closed """
+    try:
+        fp = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.path.samestat(os.fstat(fp.fileno()), os.stat(path)):
+            return fp
+    except OSError:
+        pass
+    fp.close()
+    return None
+
+
+class Spooler:
+    """ Write-behind queue: uploads are durably spooled to disk and drained to the storage by background threads """
+
+    def __init__(self, directory, workers, retries, retry_delay):
+        self.directory = directory
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        # A process forked after the workers started, as gunicorn --preload does, doesn't inherit them
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """ Forget the workers and the queue of the parent process, the child starts its own on first use """
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def path(self, guid):
+        return os.path.join(self.directory, guid)
+
+    def start(self):
+        """ Start the workers once per process, queueing what is in the spool. The worker processes sharing the spool
+        all queue the files found, each file is claimed by the first one to store it """
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.endswith(".tmp"):
+                    self._remove_abandoned(name)
+                else:
+                    self._queue.put(name)
+            for _ in range(self.workers):
+                threading.Thread(target=self._drain, daemon=True).start()
+            self._started = True
+
+    def spool(self, stream, guid):
+        """ Durably write the upload to the spool and queue it """
+        self.start()
+        path = self.path(guid)
+        with open(path + ".tmp", "wb") as fp:
+            # Held until the file is complete, so that starting processes don't take it for an abandoned one
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+            fp.flush()
+            os.fsync(fp.fileno())
+            os.replace(path + ".tmp", path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._queue.put(guid)
+
+    def _remove_abandoned(self, name):
+        fp = claim(self.path(name))
+        if fp is None:
+            return
+        with fp:
+            if time.time() - os.fstat(fp.fileno()).st_mtime > STALE_TMP_AGE:
+                self.discard(name)
+
+    def discard(self, guid):
+        try:
+            os.remove(self.path(guid))
+        except FileNotFoundError:
+            pass
+
+    def _drain(self):
+        while True:
+            guid = self._queue.get()
+            try:
+                with app.app_context():
+                    self._store(guid)
+            except Exception:
+                app.logger.exception("Error draining %s from the spool", guid)
+            finally:
+                self._queue.task_done()
+
+    def _store(self, guid):
+        claimed = claim(self.path(guid))
+        if claimed is None:
+            # Stored already, or being stored by another worker process
+            return
+        with claimed:
+            self._store_claimed(guid, claimed)
+
+    def _store_claimed(self, guid, claimed):
+        image = Image.query.filter_by(guid=guid).first()
+        if image is None:
+            # The image was deleted while waiting in the spool
+            self.discard(guid)
+            return
+        user_id = image.user_id
+        digest = content_digest(claimed)
+        for attempt in range(self.retries):
+            try:
+                with open(self.path(guid), "rb") as fp:
+                    written = store_content(digest, fp, sniff_mimetype(fp))
+                break
+            except StorageError:
+                db.session.rollback()
+                time.sleep(self.retry_delay * 2 ** attempt)
+        else:
+            # Left in the spool, it is retried when the next process starts
+            Image.query.filter_by(guid=guid).update({"status": FAILED})
+            db.session.commit()
+            invalidate_user(user_id)
+            return
+        updated = Image.query.filter_by(guid=guid).update({"status": ACTIVE, "blob_digest": digest})
+        if updated:
+            db.session.commit()
+            if written:
+                derivatives.submit(digest)
+        else:
+            # The image was deleted meanwhile, the reference taken on its content is dropped
+            db.session.rollback()
+            if written:
+                forget_contents([digest])
+        invalidate_user(user_id)
+        self.discard(guid)
+
+    def join(self):
+        """ Wait until the queued uploads are drained """
+        self._queue.join()
+
+
+spooler = Spooler(config["spool_dir"], config["spool_workers"], config["spool_retries"], config["spool_retry_delay"])
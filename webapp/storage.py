@@ -0,0 +1,317 @@
+import io
+import os
+import shutil
+import time
+import uuid
+
+from botocore.exceptions import BotoCoreError, ClientError
+from werkzeug.http import parse_range_header
+from webapp.api.model import Image, Blob
+from webapp.modules import app, config, db
+from webapp.s3 import s3_client, transfer_config
+from webapp.util import sniff_mimetype, image_dimensions
+
+CHUNK_SIZE = 64 * 1024
+# Leading bytes of the stored images read for their dimensions, past the metadata preceding them in JPEG files
+HEADER_SIZE = 256 * 1024
+
+
+class StorageError(Exception):
+    def __init__(self, code, message=""):
+        super().__init__("{}: {}".format(code, message) if message else code)
+        self.code = code
+
+
+class StoredObject:
+    """ Content of a stored object, or of the requested range of it, iterated in chunks """
+
+    def __init__(self, chunks, content_type, length, content_range=None, close=None):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.length = length
+        self.content_range = content_range
+        self._close = close
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+class Storage:
+    """ Where the image files are kept, each driver implements these methods """
+
+    def put(self, stream, key, content_type):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """ Delete the object, deleting a missing one is not an error """
+        raise NotImplementedError()
+
+    def delete_many(self, keys):
+        """ Delete the objects, returns the errors as dicts with the Key, Code and Message """
+        errors = []
+        for key in keys:
+            try:
+                self.delete(key)
+            except StorageError as e:
+                errors.append({"Key": key, "Code": e.code, "Message": str(e)})
+        return errors
+
+    def head(self, key):
+        """ Content type and size of the object, None if it doesn't exist """
+        raise NotImplementedError()
+
+    def get(self, key, byte_range=None):
+        """ StoredObject with the content of the object, or of the range given as a Range header """
+        raise NotImplementedError()
+
+    def open(self, key):
+        """ Local file of the object, to serve it without copying, None if the driver isn't local """
+        return None
+
+    def url(self, key):
+        """ URL to read the object directly, None if it can only be read through the API """
+        return None
+
+    def presign(self, key, content_type, size, expires_in):
+        """ URL and fields of a form uploading the object directly, None if the driver doesn't support it """
+        return None
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket, url_template):
+        self.bucket = bucket
+        self.url_template = url_template
+
+    @staticmethod
+    def error(e):
+        if isinstance(e, ClientError):
+            return StorageError(e.response["Error"]["Code"], str(e))
+        return StorageError(type(e).__name__, str(e))
+
+    def put(self, stream, key, content_type):
+        """ Stream the file to the bucket, through the thread-safe client so it can run in a pool """
+        from boto3.exceptions import S3UploadFailedError
+        try:
+            s3_client().upload_fileobj(stream, self.bucket, key,
+                                       ExtraArgs={"ContentType": content_type, "ACL": "public-read"},
+                                       Config=transfer_config())
+        except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+            raise self.error(e) from e
+
+    def delete(self, key):
+        try:
+            s3_client().delete_object(Bucket=self.bucket, Key=key)
+        except (BotoCoreError, ClientError) as e:
+            raise self.error(e) from e
+
+    def delete_many(self, keys):
+        """ Delete the keys from the bucket in batches, returns the errors reported by S3 """
+        errors = []
+        try:
+            for start in range(0, len(keys), 1000):
+                batch = [{"Key": key} for key in keys[start:start + 1000]]
+                result = s3_client().delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+                errors.extend(result.get("Errors", []))
+        except (BotoCoreError, ClientError) as e:
+            raise self.error(e) from e
+        return errors
+
+    def head(self, key):
+        try:
+            head = s3_client().head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise self.error(e) from e
+        except BotoCoreError as e:
+            raise self.error(e) from e
+        return head["ContentType"], head["ContentLength"]
+
+    def get(self, key, byte_range=None):
+        try:
+            stored = s3_client().get_object(Bucket=self.bucket, Key=key,
+                                            **({"Range": byte_range} if byte_range else {}))
+        except (BotoCoreError, ClientError) as e:
+            raise self.error(e) from e
+        return StoredObject(stored["Body"].iter_chunks(config["stream_chunk_kb"] * 1024), stored["ContentType"],
+                            stored["ContentLength"], stored.get("ContentRange"), stored["Body"].close)
+
+    def url(self, key):
+        return self.url_template.format(bucket_name=self.bucket, guid=key)
+
+    def presign(self, key, content_type, size, expires_in):
+        fields = {"Content-Type": content_type, "acl": "public-read"}
+        conditions = [{"Content-Type": content_type}, {"acl": "public-read"}, ["content-length-range", 1, size]]
+        try:
+            return s3_client().generate_presigned_post(self.bucket, key, Fields=fields, Conditions=conditions,
+                                                       ExpiresIn=expires_in)
+        except (BotoCoreError, ClientError) as e:
+            raise self.error(e) from e
+
+
+class LocalStorage(Storage):
+    """ Files on the local disk, sharded in directories by the leading characters of the key.
+    Files are written to a temporary name and renamed once complete, so readers never see partial files """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, stream, key, content_type):
+        path = self.path(key)
+        temp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, "wb") as fp:
+                shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, path)
+        except OSError as e:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise StorageError(type(e).__name__, str(e)) from e
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise StorageError(type(e).__name__, str(e)) from e
+
+    def head(self, key):
+        fp = self.open(key)
+        if fp is None:
+            return None
+        with fp:
+            return sniff_mimetype(fp), os.fstat(fp.fileno()).st_size
+
+    def get(self, key, byte_range=None):
+        fp = self.open(key)
+        if fp is None:
+            raise StorageError("NoSuchKey", key)
+        content_type = sniff_mimetype(fp)
+        size = os.fstat(fp.fileno()).st_size
+        start, stop, content_range = 0, size, None
+        if byte_range:
+            parsed = parse_range_header(byte_range)
+            bounds = parsed.range_for_length(size) if parsed else None
+            if bounds is None:
+                fp.close()
+                raise StorageError("InvalidRange", byte_range)
+            start, stop = bounds
+            content_range = "bytes {}-{}/{}".format(start, stop - 1, size)
+        fp.seek(start)
+
+        def chunks(left=stop - start):
+            while left > 0:
+                chunk = fp.read(min(CHUNK_SIZE, left))
+                if not chunk:
+                    return
+                left -= len(chunk)
+                yield chunk
+
+        return StoredObject(chunks(), content_type, stop - start, content_range, fp.close)
+
+    def open(self, key):
+        try:
+            return open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+
+def create_storage(settings):
+    if settings["storage_backend"] == "s3":
+        return S3Storage(settings["bucket_name"], settings["storage"])
+    if settings["storage_backend"] == "local":
+        return LocalStorage(settings["storage_dir"])
+    raise ValueError("Unknown storage backend {}".format(settings["storage_backend"]))
+
+
+storage = create_storage(config)
+
+
+def expire_pending_uploads(now=None):
+    """ Remove the pending images whose upload was never completed, returns how many were removed """
+    cutoff = (now or time.time()) - config["presigned_expiry"]
+    expired = Image.expired_reserved(cutoff)
+    guids = [image.guid for image in expired]
+    if guids:
+        # The object may have been uploaded even if the upload was never completed
+        storage.delete_many(guids)
+        expired.delete(synchronize_session=False)
+        db.session.commit()
+    return len(guids)
+
+
+def derivative_key(key, name):
+    """ Key of a derivative of the content, stored next to it """
+    return "{}-{}".format(key, name)
+
+
+def stored_dimensions(key):
+    """ Width and height of the stored image, read from the leading bytes of the object, None if they can't be read """
+    try:
+        stored = storage.get(key, "bytes=0-{}".format(HEADER_SIZE - 1))
+        try:
+            header = b"".join(stored)
+        finally:
+            stored.close()
+    except StorageError:
+        app.logger.exception("Error reading the header of %s", key)
+        return None, None
+    return image_dimensions(io.BytesIO(header))
+
+
+def store_content(digest, stream, content_type, count=1, written=False):
+    """ Take references on the blob of the content in the current transaction, the content is written to the storage
+    under its digest unless it was written already or a blob has the same digest. Returns whether it was written,
+    raises StorageError while the content is being deleted """
+    if not written:
+        if Blob.exists(digest):
+            if Blob.acquire(digest, count):
+                return False
+            if Blob.exists(digest):
+                raise StorageError("ContentBeingDeleted", digest)
+        # New content, or content whose last image was deleted meanwhile
+        storage.put(stream, digest, content_type)
+    Blob.reference(digest, count)
+    return True
+
+
+def forget_contents(digests):
+    """ Delete the contents written for a transaction that was rolled back, unless a blob references them """
+    orphans = [digest for digest in digests if not Blob.exists(digest)]
+    if orphans:
+        storage.delete_many(orphans)
+
+
+def delete_image(image):
+    """ Delete the image in the current transaction, and its content and derivatives from the storage unless other
+    images share them. Returns the keys deleted from the storage """
+    image_id, digest, key = image.id, image.blob_digest, image.key
+    deleted = []
+    if digest is None or Blob.release(digest):
+        names = image.derivative_names
+        storage.delete(key)
+        deleted.append(key)
+        # Once the content is deleted the image goes with it, the derivatives are left behind if they can't be
+        for name in names:
+            try:
+                storage.delete(derivative_key(key, name))
+                deleted.append(derivative_key(key, name))
+            except StorageError:
+                app.logger.exception("Error deleting the derivative %s of %s", name, key)
+    Image.query.filter_by(id=image_id).delete()
+    if digest is not None:
+        Blob.remove_unreferenced([digest])
+    return deleted
@@ -1,8 +1,17 @@
-from flask import session
+from flask import session, request, Request, Response
+import base64
+import binascii
+import functools
+import hashlib
 import re
-import magic
-import sys
+import threading
+import os
+from urllib.parse import urlencode
+from sqlalchemy import true
+from werkzeug.formparser import default_stream_factory
+from werkzeug.http import http_date, parse_date, quote_etag
 from webapp.api.model import User
+from webapp.cache import TTLCache, FileSystemCache, ResponseCache, BlobCache
 from webapp.modules import schemas, config
 
 
@@ -25,6 +34,139 @@ def add_self(object: dict, link):
     object["_links"]["self"] = self_link
 
 
+def add_link(object: dict, name, link):
+    if "_links" not in object:
+        object["_links"] = dict()
+    object["_links"][name] = {"href": link}
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor {}".format(cursor))
+
+
+class Page:
+    """ Keyset pagination over an integer key, driven by the limit/after/before arguments """
+
+    def __init__(self, args):
+        limit = config["page_size"] if args["limit"] is None else args["limit"]
+        if limit < 1:
+            raise ValueError("Invalid page size {}".format(limit))
+        if args["after"] and args["before"]:
+            raise ValueError("Only one of after and before can be given")
+        self.limit = min(limit, config["max_page_size"])
+        self.after = decode_cursor(args["after"]) if args["after"] else None
+        self.before = decode_cursor(args["before"]) if args["before"] else None
+        self.next = None
+        self.prev = None
+
+    def bounds(self, column):
+        """ Condition and ordering selecting the page rows, fetch limit + 1 of them """
+        if self.before is not None:
+            return column < self.before, column.desc()
+        if self.after is not None:
+            return column > self.after, column.asc()
+        return true(), column.asc()
+
+    def slice(self, rows, key):
+        """ Trim the extra row and compute the cursors of the neighbouring pages """
+        more = len(rows) > self.limit
+        rows = list(rows[:self.limit])
+        if self.before is not None:
+            rows.reverse()
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, self.after is not None
+        if rows:
+            self.next = encode_cursor(key(rows[-1])) if has_next else None
+            self.prev = encode_cursor(key(rows[0])) if has_prev else None
+        return rows
+
+    def href(self, link, **cursor):
+        return "{}?{}".format(link, urlencode({"limit": self.limit, **cursor}))
+
+
+def add_page_links(object: dict, link, page: Page):
+    if page.after is not None:
+        add_self(object, page.href(link, after=encode_cursor(page.after)))
+    elif page.before is not None:
+        add_self(object, page.href(link, before=encode_cursor(page.before)))
+    else:
+        add_self(object, page.href(link))
+    if page.next:
+        add_link(object, "next", page.href(link, after=page.next))
+    if page.prev:
+        add_link(object, "prev", page.href(link, before=page.prev))
+
+
+def validators(rows, last_modified=None):
+    """ Strong validators of a response, computed from the rows it is built from """
+    digest = hashlib.sha1(repr((request.full_path, [tuple(row) for row in rows])).encode())
+    headers = {"ETag": quote_etag(digest.hexdigest())}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(headers):
+    """ A 304 response when the conditional headers of the request match the validators, None otherwise """
+    if request.if_none_match:
+        match = request.if_none_match.contains_raw(headers["ETag"])
+    elif request.if_modified_since and "Last-Modified" in headers:
+        match = parse_date(headers["Last-Modified"]) <= request.if_modified_since
+    else:
+        match = False
+    return Response(status=304, headers=headers) if match else None
+
+
+def response_cache_backend():
+    if config["response_cache"] == "memory":
+        return TTLCache(config["response_cache_size"], config["response_cache_ttl"])
+    if config["response_cache"] == "filesystem":
+        return FileSystemCache(config["response_cache_dir"], config["response_cache_size"], config["response_cache_ttl"])
+    return None
+
+
+# Read responses are cached under the "users" namespace for the list of users and
+# under the user_namespace of each user for its images
+response_cache = ResponseCache(response_cache_backend(), not_modified)
+user_namespace = "user:{user_id}"
+
+
+def invalidate_user(user_id):
+    response_cache.invalidate(user_namespace.format(user_id=user_id))
+
+
+# Images are stored under a fresh guid or the digest of their content, so their cached copy never goes stale
+image_cache = BlobCache(config["image_cache_dir"], config["image_cache_max_mb"] * 1024 * 1024)
+
+
+def cache_stream(stored, key):
+    """ Yield the chunks of the StoredObject, keeping a copy in the image cache once it's complete """
+    temp = image_cache.temp_path(key)
+    complete = False
+    try:
+        with open(temp, "wb") as fp:
+            for chunk in stored:
+                fp.write(chunk)
+                yield chunk
+        image_cache.commit(temp, key)
+        complete = True
+    finally:
+        stored.close()
+        if not complete:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+
+
 class UserBuilder(dict):
     def __init__(self, id, username):
         dict.__init__(self)
@@ -34,23 +176,113 @@ class UserBuilder(dict):
 
 
 class ImageBuilder(dict):
-    def __init__(self, user_id, image_id, guid, title):
+    def __init__(self, user_id, image_id, guid, title, width=None, height=None, size=None, derivatives=None):
         dict.__init__(self)
         self["id"] = image_id
         self["title"] = title
         self["guid"] = guid
+        self["width"] = width
+        self["height"] = height
+        self["size"] = size
         add_self(self, schemas["image"].format(user_id=user_id, image_id=image_id))
+        for name in (derivatives or "").split():
+            add_link(self, name, schemas["derivative_image"].format(user_id=user_id, image_id=image_id, name=name))
 
 
-def check_size_type(new_type, data: bytes):
+def limit_content_length(limit, message):
+    """ Answer 413 when the declared length of the request exceeds the limit, applied outside require_oauth as the
+    authentication reads, and spools, the whole body """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.content_length is not None and request.content_length > limit:
+                return {"message": message}, 413
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def check_size_type(new_type, size: int):
     image_pattern = re.compile("image/*")
     if not image_pattern.match(new_type):
         return False
-    if sys.getsizeof(data) / 1000 > config["max_size_kb"]:
+    if size / 1000 > config["max_size_kb"]:
         return False
     return True
 
 
+# libmagic handles are not thread-safe, each thread opens its own on first use
+_magic = threading.local()
+
+
 def get_mimetype(data: bytes):
-    f = magic.Magic(mime=True)
-    return f.from_buffer(data)
+    if not hasattr(_magic, "handle"):
+        import magic
+        _magic.handle = magic.Magic(mime=True)
+    return _magic.handle.from_buffer(data)
+
+
+def sniff_mimetype(stream):
+    """ Detect the MIME type from the first bytes of the stream, leaving it rewound """
+    head = stream.read(config["mime_sniff_bytes"])
+    stream.seek(0)
+    return get_mimetype(head)
+
+
+def stream_size(stream):
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    return size
+
+
+def image_dimensions(stream):
+    """ Width and height of the image, read from its header, None if they can't be read """
+    from PIL import Image as Picture, UnidentifiedImageError
+    try:
+        width, height = Picture.open(stream).size
+    except (UnidentifiedImageError, OSError, ValueError):
+        width, height = None, None
+    stream.seek(0)
+    return width, height
+
+
+class HashingFile:
+    """ File of an uploaded image, hashing the content while the form parser writes it """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._fp.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __iter__(self):
+        return iter(self._fp)
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+def hashing_stream_factory(total_content_length, content_type, filename=None, content_length=None):
+    return HashingFile(default_stream_factory(total_content_length=total_content_length, filename=filename,
+                                              content_type=content_type, content_length=content_length))
+
+
+class HashingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return hashing_stream_factory(total_content_length, content_type, filename, content_length)
+
+
+def content_digest(stream):
+    """ SHA-256 of the content of the stream, read again only when it wasn't hashed while being received """
+    if isinstance(stream, HashingFile):
+        return stream.hexdigest()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()